@@ -49,7 +49,12 @@ class ZorderAgent:
         self.record_dir = os.getenv("RECORD_DIR", r"C:\Recordings")
         self.record_seconds = int(os.getenv("RECORD_SECONDS", "180"))
         self.poll_interval = int(os.getenv("POLL_INTERVAL", "5"))
+        self.long_poll_wait = int(os.getenv("LONG_POLL_WAIT", "25"))  # 0 disables long-polling
+        self.use_stream = os.getenv("AGENT_STREAM", "1") == "1"  # push arm/disarm over SSE
         self.arm_duration = int(os.getenv("ARM_DURATION", "600"))  # 10 minutes
+        self.upload_retries = int(os.getenv("UPLOAD_RETRIES", "8"))  # consecutive chunk failures before giving up
+        self.task_lease_seconds = int(os.getenv("TASK_LEASE_SECONDS", "300"))  # renewed every third of this
+        self.agent_id = os.getenv("AGENT_ID", f"{socket.gethostname()}-{os.getpid()}")
         self.hmac_secret = os.getenv("HMAC_SECRET")
         
         # State variables
@@ -60,6 +65,12 @@ class ZorderAgent:
         self.recording_file = None
         self.is_recording = False
         self.credentials = None
+        self.stream_connected = False
+        self.last_event_id = None
+        self.use_claims = True  # cleared if the server has no /tasks/claim
+        self.lease = None
+        self.lease_renewed_at = None
+        self.tasks_etag = None  # version of the last /tasks answer, sent as If-None-Match
         
         # HTTP session for server communication
         self.session = requests.Session()
@@ -312,35 +323,14 @@ class ZorderAgent:
                 "file_size": os.path.getsize(self.recording_file)
             }
             
-            # Prepare files and data for upload
-            files = {
-                'file': (os.path.basename(self.recording_file), 
-                        open(self.recording_file, 'rb'), 
-                        'video/mp4')
-            }
-            
-            data = {
-                'meta': json.dumps(meta)
-            }
-            
-            # Prepare headers with optional HMAC
-            headers = {}
-            if self.hmac_secret:
-                headers.update(self.get_hmac_headers(json.dumps(meta)))
-            
-            # Upload to server
-            response = requests.post(
-                f"{self.server_url}/upload/recording",
-                files=files,
-                data=data,
-                headers=headers,
-                timeout=300  # 5 minute timeout for upload
-            )
-            
-            files['file'][1].close()  # Close file handle
+            # Resumable chunked upload; servers without it get the whole file at once
+            response = self.upload_recording_chunked(meta)
+            if response is None:
+                response = self.upload_recording_legacy(meta)
             
-            if response.status_code == 200:
-                logger.info("Recording uploaded successfully")
+            if response.status_code in (200, 202):
+                # 202: stored; the server sends it to WhatsApp in the background
+                logger.info(f"Recording uploaded successfully (job {response.json().get('job_id', '-')})")
                 
                 # Consume the task
                 if self.armed_task:
@@ -366,6 +356,99 @@ class ZorderAgent:
             
             self.recording_file = None
     
+    def upload_recording_legacy(self, meta):
+        """Send the whole recording in one multipart request."""
+        # Prepare headers with optional HMAC
+        headers = {}
+        if self.hmac_secret:
+            headers.update(self.get_hmac_headers(json.dumps(meta)))
+        
+        with open(self.recording_file, 'rb') as fh:
+            files = {'file': (os.path.basename(self.recording_file), fh, 'video/mp4')}
+            return requests.post(
+                f"{self.server_url}/upload/recording",
+                files=files,
+                data={'meta': json.dumps(meta)},
+                headers=headers,
+                timeout=300  # 5 minute timeout for upload
+            )
+    
+    def upload_recording_chunked(self, meta):
+        """Upload the recording in checksummed chunks, resuming after failures.
+        
+        Only the ranges the server reports missing are (re)sent, so a dropped
+        connection costs at most one chunk. Returns the finalize response, or
+        None if the server doesn't support chunked uploads.
+        """
+        path = self.recording_file
+        digest = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), b''):
+                digest.update(block)
+        
+        body = json.dumps({
+            "filename": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "sha256": digest.hexdigest(),
+            "meta": meta,
+        })
+        headers = {'Content-Type': 'application/json'}
+        if self.hmac_secret:
+            headers.update(self.get_hmac_headers(body))
+        response = self.session.post(f"{self.server_url}/upload/sessions", data=body, headers=headers, timeout=30)
+        if response.status_code == 404:
+            logger.info("Server has no chunked upload support; sending the whole file")
+            return None
+        response.raise_for_status()
+        upload = response.json()
+        url = f"{self.server_url}/upload/sessions/{upload['id']}"
+        
+        failures = 0
+        with open(path, 'rb') as fh:
+            while upload["missing"]:
+                start, end = upload["missing"][0]
+                end = min(end, start + upload["chunk_size"])
+                fh.seek(start)
+                chunk = fh.read(end - start)
+                try:
+                    response = self.session.put(url, data=chunk, timeout=(10, 60), headers={
+                        'Content-Range': f"bytes {start}-{end - 1}/{upload['size']}",
+                        'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest(),
+                        'Content-Type': 'application/octet-stream',
+                    })
+                    if response.status_code == 200:
+                        upload = response.json()
+                        failures = 0
+                        continue
+                    if response.status_code < 500 and response.status_code != 422:
+                        response.raise_for_status()
+                    logger.warning(f"Chunk {start}-{end - 1} failed: HTTP {response.status_code}")
+                except requests.ConnectionError as e:
+                    logger.warning(f"Chunk {start}-{end - 1} failed: {e}")
+                except requests.Timeout as e:
+                    logger.warning(f"Chunk {start}-{end - 1} timed out: {e}")
+                
+                failures += 1
+                if failures > self.upload_retries:
+                    raise RuntimeError(f"upload aborted after {failures} consecutive chunk failures")
+                time.sleep(min(2 ** failures, 30))
+                # Ask what actually arrived; the failed chunk may have landed anyway
+                try:
+                    response = self.session.get(url, timeout=10)
+                    if response.status_code == 200:
+                        upload = response.json()
+                except requests.RequestException as e:
+                    logger.warning(f"Could not fetch upload state: {e}")
+        
+        for attempt in range(self.upload_retries + 1):
+            try:
+                return self.session.post(f"{url}/finalize", timeout=300)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # Finalize is idempotent, so a lost response is safe to retry
+                logger.warning(f"Finalize failed: {e}")
+                time.sleep(min(2 ** (attempt + 1), 30))
+        raise RuntimeError("upload finalize failed")
+    
     def get_hmac_headers(self, body):
         """Generate HMAC headers for request authentication."""
         if not self.hmac_secret:
@@ -403,32 +486,216 @@ class ZorderAgent:
             return "unknown"
     
     def poll_tasks(self):
-        """Poll server for approved tasks."""
+        """Poll server for approved tasks.
+        
+        While disarmed, the request long-polls: the server holds it open for up
+        to LONG_POLL_WAIT seconds and answers as soon as a task is approved.
+        Returns True if the server already waited for us, so the caller can
+        poll again straight away. The last answer's ETag goes back as
+        If-None-Match, so an unchanged task list costs a bodiless 304.
+        """
+        wait = self.long_poll_wait if not self.is_armed else 0
         try:
+            if self.use_claims and not self.is_armed:
+                # Claiming long-polls too, and hands over the task with its lease
+                claimed = self.claim_task(wait)
+                if claimed is not False:
+                    if claimed:
+                        self.arm_with_task(claimed)
+                    return bool(wait)
+            
             response = requests.get(
                 f"{self.server_url}/tasks/{self.machine_id}",
-                timeout=10
+                params={"wait": wait} if wait else None,
+                headers={"If-None-Match": self.tasks_etag} if self.tasks_etag else None,
+                timeout=wait + 10
             )
             
-            if response.status_code == 200:
+            if response.status_code == 304:
+                # Nothing changed since the last poll
+                return bool(wait)
+            elif response.status_code == 200:
+                self.tasks_etag = response.headers.get("ETag")
                 tasks = response.json()
                 if tasks and not self.is_armed:
                     # Arm with the first available task
-                    self.arm_with_task(tasks[0])
+                    self.claim_and_arm(tasks[0])
                 elif not tasks and self.is_armed:
                     # Check if armed task is still valid
                     self.check_arm_expiry()
+                return bool(wait)
             else:
                 logger.warning(f"Task polling failed: HTTP {response.status_code}")
                 
         except Exception as e:
             logger.error(f"Failed to poll tasks: {e}")
+        return False
+    
+    def start_event_stream(self):
+        """Start the background thread that follows the server's event stream."""
+        stream_thread = threading.Thread(target=self.stream_events)
+        stream_thread.daemon = True
+        stream_thread.start()
+    
+    def stream_events(self):
+        """Follow /agent/stream/<machine_id> and arm/disarm as events arrive.
+        
+        Reconnects with Last-Event-ID after any drop, so the server replays
+        whatever was missed. Gives up (and leaves polling in charge) if the
+        server has no stream endpoint.
+        """
+        backoff = 1
+        while True:
+            try:
+                headers = {"Accept": "text/event-stream"}
+                if self.last_event_id:
+                    headers["Last-Event-ID"] = self.last_event_id
+                
+                with self.session.get(
+                    f"{self.server_url}/agent/stream/{self.machine_id}",
+                    headers=headers,
+                    stream=True,
+                    timeout=(10, 60)  # server sends a keepalive well within 60s
+                ) as response:
+                    if response.status_code == 404:
+                        logger.warning("Server has no event stream - using polling only")
+                        return
+                    response.raise_for_status()
+                    
+                    self.stream_connected = True
+                    backoff = 1
+                    logger.info("Event stream connected")
+                    
+                    event, data, event_id = None, [], None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line is None:
+                            continue
+                        if not line:
+                            # Blank line terminates one event
+                            if event or data:
+                                self.handle_stream_event(event or "message", "\n".join(data))
+                            if event_id is not None:
+                                self.last_event_id = event_id
+                            event, data, event_id = None, [], None
+                        elif line.startswith(":"):
+                            continue  # keepalive comment
+                        else:
+                            field, _, value = line.partition(":")
+                            value = value[1:] if value.startswith(" ") else value
+                            if field == "event":
+                                event = value
+                            elif field == "data":
+                                data.append(value)
+                            elif field == "id":
+                                event_id = value
+                
+            except Exception as e:
+                logger.warning(f"Event stream disconnected: {e}")
+            
+            self.stream_connected = False
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+    
+    def handle_stream_event(self, event, data):
+        """Apply one arm/disarm/expire event from the server."""
+        try:
+            payload = json.loads(data) if data else {}
+        except ValueError:
+            logger.warning(f"Ignoring malformed stream event: {data!r}")
+            return
+        
+        if event == "arm":
+            if not self.is_armed:
+                self.claim_and_arm(payload)
+        elif event in ("disarm", "expire"):
+            # Only drop the task we're armed with, and never mid-recording
+            if (self.is_armed and not self.is_recording and self.armed_task
+                    and self.armed_task.get("id") == payload.get("id")):
+                logger.info(f"Server sent {event} for task {payload.get('id')}")
+                self.disarm()
+    
+    def post_json(self, path, data, timeout=10):
+        """POST a JSON body to the server, HMAC-signed if configured."""
+        headers = {"Content-Type": "application/json"}
+        if self.hmac_secret:
+            headers.update(self.get_hmac_headers(json.dumps(data)))
+        return self.session.post(f"{self.server_url}{path}", json=data, headers=headers, timeout=timeout)
+    
+    def claim_task(self, wait=0):
+        """Claim this machine's newest allowed task under a lease.
+        
+        The server hands a task to one agent at a time, so redundant agents
+        sharing a machine id never arm on the same approval. Returns the task
+        (with its lease), None if there was nothing to claim, or False if the
+        server has no claim endpoint.
+        """
+        response = self.post_json("/tasks/claim", {
+            "machine_id": self.machine_id,
+            "owner": self.agent_id,
+            "lease_seconds": self.task_lease_seconds,
+            "wait": wait,
+        }, timeout=wait + 10)
+        if response.status_code == 404:
+            logger.warning("Server has no task claims - arming from /tasks without a lease")
+            self.use_claims = False
+            return False
+        if response.status_code == 204:
+            return None
+        response.raise_for_status()
+        return response.json()
+    
+    def claim_and_arm(self, task):
+        """Arm for an announced task, claiming it first where the server supports leases."""
+        try:
+            claimed = self.claim_task() if self.use_claims else False
+        except Exception as e:
+            logger.error(f"Failed to claim task: {e}")
+            return
+        if claimed is False:
+            self.arm_with_task(task)
+        elif claimed:
+            self.arm_with_task(claimed)
+        else:
+            logger.info(f"Task {task.get('id')} was claimed by another agent")
+    
+    def renew_lease(self):
+        """Keep the armed task's lease alive; disarm if another agent has taken it over."""
+        if not self.lease or time.time() - self.lease_renewed_at < self.lease.get("seconds", 300) / 3:
+            return
+        try:
+            response = self.post_json("/tasks/renew", {
+                "id": self.armed_task["id"],
+                "lease_token": self.lease["token"],
+                "lease_seconds": self.lease.get("seconds"),
+            })
+            if response.status_code == 409:
+                logger.warning(f"Lease on task {self.armed_task['id']} lost")
+                self.lease = None
+                if not self.is_recording:
+                    self.disarm()
+                return
+            response.raise_for_status()
+            self.lease_renewed_at = time.time()
+        except Exception as e:
+            logger.warning(f"Failed to renew lease: {e}")
+    
+    def release_lease(self):
+        """Hand an unused task back so another agent can claim it straight away."""
+        lease, task, self.lease = self.lease, self.armed_task, None
+        if not lease or not task:
+            return
+        try:
+            self.post_json("/tasks/release", {"id": task["id"], "lease_token": lease["token"]})
+        except Exception as e:
+            logger.warning(f"Failed to release task {task['id']}: {e}")
     
     def arm_with_task(self, task):
         """Arm the agent with a specific task."""
         self.is_armed = True
         self.armed_task = task
         self.arm_time = time.time()
+        self.lease = task.get("lease")
+        self.lease_renewed_at = time.time()
         
         logger.info(f"Agent ARMED with task {task['id']} for invoice {task['invoice_id']}")
         logger.info(f"Armed for {self.arm_duration} seconds - F5/F6 hotkeys active")
@@ -442,7 +709,9 @@ class ZorderAgent:
                 self.disarm()
     
     def disarm(self):
-        """Disarm the agent."""
+        """Disarm the agent, releasing the task's lease if it wasn't used."""
+        self.release_lease()
+        self.tasks_etag = None  # so a task that is still there can arm us again
         self.is_armed = False
         self.armed_task = None
         self.arm_time = None
@@ -452,20 +721,14 @@ class ZorderAgent:
         """Mark a task as consumed on the server."""
         try:
             data = {"id": action_id}
-            headers = {"Content-Type": "application/json"}
+            if self.lease:
+                data["lease_token"] = self.lease["token"]
             
-            # Add HMAC headers if configured
-            if self.hmac_secret:
-                headers.update(self.get_hmac_headers(json.dumps(data)))
-            
-            response = requests.post(
-                f"{self.server_url}/tasks/consume",
-                json=data,
-                headers=headers,
-                timeout=10
-            )
+            response = self.post_json("/tasks/consume", data)
             
             if response.status_code == 200:
+                # Consuming ends the lease on the server
+                self.lease = None
                 logger.info(f"Task {action_id} consumed successfully")
             else:
                 logger.warning(f"Task consumption failed: HTTP {response.status_code}")
@@ -488,17 +751,30 @@ class ZorderAgent:
             logger.error("FFmpeg not found - screen recording will not work")
             logger.error("Please install FFmpeg: winget install ffmpeg")
         
+        if self.use_stream:
+            self.start_event_stream()
+        
         try:
             while True:
-                # Poll for tasks
-                self.poll_tasks()
+                if self.stream_connected:
+                    # Arming arrives over the event stream; just watch the arm timer
+                    if self.is_armed:
+                        self.renew_lease()
+                        self.check_arm_expiry()
+                    time.sleep(self.poll_interval)
+                    continue
                 
-                # Check arm expiry
+                # Poll for tasks (long-polls while disarmed)
+                long_polled = self.poll_tasks()
+                
+                # Keep the lease alive and check arm expiry
                 if self.is_armed:
+                    self.renew_lease()
                     self.check_arm_expiry()
                 
-                # Wait before next poll
-                time.sleep(self.poll_interval)
+                # Wait before next poll, unless the server already held the request
+                if not long_polled:
+                    time.sleep(self.poll_interval)
                 
         except KeyboardInterrupt:
             logger.info("Agent stopping...")
@@ -514,6 +790,9 @@ class ZorderAgent:
             if self.is_recording:
                 self.stop_recording()
             
+            # Let another agent on this machine pick up a task we never used
+            self.release_lease()
+            
             # Stop keyboard listener
             if self.keyboard_listener:
                 self.keyboard_listener.stop()
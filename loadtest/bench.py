@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+End-to-end load benchmark for the approval pipeline.
+
+Drives a server (in-process by default, on a throwaway database, talking to
+the in-process WhatsApp stand-in from mock_whatsapp.py) with:
+
+  * N simulated agents polling /tasks/<machine_id> and /agent/arm-status/<machine_id>
+    and consuming tasks once they see them
+  * M console-style /event/bill-edited submissions per second
+  * a webhook approval for every submitted edit, POSTed like Meta would
+  * recording uploads to /upload/recording
+
+and reports throughput and p50/p95/p99 latency per endpoint, the edit-to-armed
+latency an agent experiences, and SQLite write-lock contention. Results are
+written as JSON so runs can be compared across versions:
+
+    python loadtest/bench.py --agents 200 --edits-per-sec 20 --duration 60
+    python loadtest/bench.py --compare loadtest/results/baseline.json
+
+--compare exits non-zero if any endpoint's p95 got worse than --regression-pct.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", help="Benchmark a running server instead of an in-process one")
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between agent polls")
+    parser.add_argument("--edits-per-sec", type=float, default=10)
+    parser.add_argument("--approval-delay", type=float, default=0.5, help="seconds before the owner approves")
+    parser.add_argument("--owner", default="910000000000",
+                        help="WhatsApp number replies come from (the server's OWNER_WA_NUMBER)")
+    parser.add_argument("--uploads-per-sec", type=float, default=0.5)
+    parser.add_argument("--upload-kb", type=int, default=2048, help="size of each synthetic recording")
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--mock-latency-ms", type=float, default=150, help="in-process WhatsApp API latency")
+    parser.add_argument("--out", help="result file (default loadtest/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="previous result file to compare against")
+    parser.add_argument("--regression-pct", type=float, default=20, help="p95 slowdown that counts as a regression")
+    return parser.parse_args(argv)
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def serve(wsgi_app, port=0):
+    from werkzeug.serving import make_server
+
+    httpd = make_server("127.0.0.1", port, wsgi_app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def start_in_process(args):
+    """Start the WhatsApp stand-in and the server in this process; returns (url, server module)."""
+    import mock_whatsapp
+
+    mock = serve(mock_whatsapp.create_app(mock_whatsapp.parse_args(
+        ["--latency-ms", str(args.mock_latency_ms), "--rate-limit", "0"])))
+
+    tmp = tempfile.mkdtemp(prefix="zorder-bench-")
+    os.environ.update({
+        "DB_PATH": os.path.join(tmp, "bench.db"),
+        "UPLOAD_DIR": os.path.join(tmp, "uploads"),
+        "WHATSAPP_API_BASE": f"http://127.0.0.1:{mock.server_port}",
+        "WHATSAPP_TOKEN": "bench",
+        "WHATSAPP_PHONE_ID": "100000000000000",
+        "OWNER_WA_NUMBER": args.owner,
+        # The owner is one recipient; don't let Meta's pair limit throttle the benchmark
+        "WHATSAPP_PAIR_RATE_PER_SECOND": "1000",
+        "WHATSAPP_PAIR_BURST": "1000",
+    })
+    sys.path.insert(0, os.path.join(HERE, "..", "server"))
+    import logging
+    import app as server_app
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    logging.getLogger("app").setLevel(logging.WARNING)
+    server = serve(server_app.app, free_port())
+    return f"http://127.0.0.1:{server.server_port}", server_app
+
+
+class Recorder:
+    """Collects per-endpoint latency samples once measuring has started."""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.measuring = False
+        self._lock = threading.Lock()
+
+    def call(self, label, fn, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = fn(*args, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        if self.measuring:
+            with self._lock:
+                self.samples[label].append(elapsed)
+                if not ok:
+                    self.errors[label] += 1
+        return response if ok else None
+
+    def observe(self, label, seconds):
+        if self.measuring:
+            with self._lock:
+                self.samples[label].append(seconds)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def summarize(recorder, duration):
+    endpoints = {}
+    for label, values in sorted(recorder.samples.items()):
+        ms = [v * 1000 for v in values]
+        endpoints[label] = {
+            "count": len(ms),
+            "errors": recorder.errors.get(label, 0),
+            "throughput_rps": round(len(ms) / duration, 2),
+            "p50_ms": round(percentile(ms, 50), 2),
+            "p95_ms": round(percentile(ms, 95), 2),
+            "p99_ms": round(percentile(ms, 99), 2),
+            "max_ms": round(max(ms), 2),
+        }
+    return endpoints
+
+
+def run(args):
+    server_app = None
+    if args.server:
+        base = args.server.rstrip("/")
+    else:
+        base, server_app = start_in_process(args)
+
+    rec = Recorder()
+    stop = threading.Event()
+    edits_sent_at = {}
+    edits_lock = threading.Lock()
+    run_id = uuid.uuid4().hex[:6]
+    machines = [f"BENCH-{run_id}-{i}" for i in range(args.agents)]
+    recording = os.urandom(args.upload_kb * 1024)
+
+    def agent(machine_id):
+        session = requests.Session()
+        time.sleep(random.uniform(0, args.poll_interval))
+        while not stop.is_set():
+            r = rec.call("GET /tasks/<machine_id>", session.get, f"{base}/tasks/{machine_id}", timeout=30)
+            for task in (r.json() if r is not None else []):
+                with edits_lock:
+                    sent_at = edits_sent_at.pop(task["id"], None)
+                if sent_at is not None:
+                    rec.observe("edit->armed", time.perf_counter() - sent_at)
+                rec.call("POST /tasks/consume", session.post, f"{base}/tasks/consume",
+                         json={"id": task["id"]}, timeout=30)
+            rec.call("GET /agent/arm-status/<machine_id>", session.get,
+                     f"{base}/agent/arm-status/{machine_id}", timeout=30)
+            stop.wait(args.poll_interval)
+
+    def approve(action_id):
+        # The server only accepts a reply from the number its prompt went to
+        body = {"entry": [{"changes": [{"value": {"messages": [{
+            "from": args.owner, "id": f"wamid.{uuid.uuid4().hex}", "type": "interactive",
+            "interactive": {"type": "button_reply", "button_reply": {"id": f"yes_{action_id}", "title": "YES"}},
+        }]}}]}]}
+        rec.call("POST /webhook/whatsapp", requests.post, f"{base}/webhook/whatsapp", json=body, timeout=30)
+
+    def edit(n):
+        machine_id = random.choice(machines)
+        started = time.perf_counter()
+        r = rec.call("POST /event/bill-edited", requests.post, f"{base}/event/bill-edited", timeout=30,
+                     json={"invoice_id": f"INV-{run_id}-{n}", "biller_id": "bench", "machine_id": machine_id})
+        if r is not None and r.json().get("action_id"):
+            action_id = r.json()["action_id"]
+            with edits_lock:
+                edits_sent_at[action_id] = started
+            timer = threading.Timer(args.approval_delay, approve, (action_id,))
+            timer.daemon = True
+            timer.start()
+
+    def upload(n):
+        meta = {"machine_id": random.choice(machines), "invoice_id": f"INV-{run_id}-{n}", "host": "bench"}
+        rec.call("POST /upload/recording", requests.post, f"{base}/upload/recording", timeout=300,
+                 files={"file": (f"bench_{run_id}_{n}.mp4", recording, "video/mp4")},
+                 data={"meta": json.dumps(meta)})
+
+    def open_loop(rate, fn, pool):
+        """Submit fn at a fixed rate regardless of how long calls take."""
+        if rate <= 0:
+            return
+        n, interval, next_at = 0, 1 / rate, time.perf_counter()
+        while not stop.is_set():
+            pool.submit(fn, n)
+            n += 1
+            next_at += interval
+            stop.wait(max(0.0, next_at - time.perf_counter()))
+
+    pool = ThreadPoolExecutor(max_workers=64)
+    threads = [threading.Thread(target=agent, args=(m,), daemon=True) for m in machines]
+    threads.append(threading.Thread(target=open_loop, args=(args.edits_per_sec, edit, pool), daemon=True))
+    threads.append(threading.Thread(target=open_loop, args=(args.uploads_per_sec, upload, pool), daemon=True))
+    for t in threads:
+        t.start()
+
+    print(f"Warming up for {args.warmup}s against {base} ...")
+    time.sleep(args.warmup)
+    db_before = server_app.db.stats() if server_app else None
+    rec.measuring = True
+    started = time.perf_counter()
+    print(f"Measuring for {args.duration}s ...")
+    time.sleep(args.duration)
+    rec.measuring = False
+    elapsed = time.perf_counter() - started
+    db_after = server_app.db.stats() if server_app else None
+    stop.set()
+    pool.shutdown(wait=True, cancel_futures=True)
+
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "compare")},
+        "duration_s": round(elapsed, 2),
+        "endpoints": summarize(rec, elapsed),
+    }
+    if db_before is not None:
+        txns = db_after["transactions"] - db_before["transactions"]
+        wait = db_after["lock_wait_seconds"] - db_before["lock_wait_seconds"]
+        result["sqlite"] = {
+            "write_transactions": txns,
+            "lock_wait_total_ms": round(wait * 1000, 2),
+            "lock_wait_avg_ms": round(wait * 1000 / txns, 3) if txns else 0.0,
+            "lock_wait_max_ms": round(db_after["lock_wait_max_seconds"] * 1000, 2),
+            "busy_errors": db_after["busy_errors"] - db_before["busy_errors"],
+            "pool_waits": db_after["pool_waits"] - db_before["pool_waits"],
+            "pool_timeouts": db_after["pool_timeouts"] - db_before["pool_timeouts"],
+        }
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_report(result):
+    print(f"\nZorder benchmark @ {result['version']} ({result['duration_s']}s)")
+    print(f"{'endpoint':40} {'count':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    for label, s in result["endpoints"].items():
+        print(f"{label:40} {s['count']:>7} {s['errors']:>5} {s['throughput_rps']:>8} "
+              f"{s['p50_ms']:>8} {s['p95_ms']:>8} {s['p99_ms']:>8} {s['max_ms']:>8}")
+    if "sqlite" in result:
+        s = result["sqlite"]
+        print(f"\nSQLite: {s['write_transactions']} write txns, lock wait avg {s['lock_wait_avg_ms']} ms "
+              f"max {s['lock_wait_max_ms']} ms, busy errors {s['busy_errors']}, pool waits {s['pool_waits']}, "
+              f"pool timeouts {s['pool_timeouts']}")
+
+
+def compare(result, baseline, threshold_pct):
+    """Print p95 deltas against a baseline; returns True if anything regressed."""
+    print(f"\nCompared with {baseline['version']} ({baseline['timestamp']}):")
+    regressed = False
+    for label, s in result["endpoints"].items():
+        old = baseline["endpoints"].get(label)
+        if not old or not old["p95_ms"]:
+            continue
+        delta = (s["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+        flag = ""
+        if delta > threshold_pct:
+            flag, regressed = "  REGRESSION", True
+        print(f"  {label:40} p95 {old['p95_ms']:>8} -> {s['p95_ms']:>8} ms ({delta:+.1f}%){flag}")
+    return regressed
+
+
+def main():
+    args = parse_args()
+    result = run(args)
+    print_report(result)
+
+    out = args.out or os.path.join(HERE, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as fh:
+        json.dump(result, fh, indent=2)
+    print(f"\nResults written to {out}")
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        status = 1 if compare(result, baseline, args.regression_pct) else 0
+    sys.stdout.flush()
+    os._exit(status)  # don't wait on the in-process servers' threads
+
+
+if __name__ == "__main__":
+    main()
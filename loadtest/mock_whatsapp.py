@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the WhatsApp Cloud API, for offline load testing.
+
+Implements the parts of the Graph API the server uses:
+
+    POST /<version>/<phone_id>/messages   text, interactive button/list, video
+    POST /<version>/<phone_id>/media      media upload (body is read and discarded)
+
+with configurable latency, error rate and rate limiting (429 + Retry-After,
+like Meta's throughput limit). When an interactive approval prompt arrives it
+plays the owner: after --reply-delay seconds it POSTs a YES (or NO) button
+reply to the server's /webhook/whatsapp, optionally delivering it twice the
+way Meta's webhook retries do. For a bulk approval list it picks Allow or
+Reject in every section, one list reply per pick.
+
+Run it next to the server:
+
+    python loadtest/mock_whatsapp.py --port 9000 --webhook http://127.0.0.1:8000/webhook/whatsapp
+    WHATSAPP_API_BASE=http://127.0.0.1:9000 WHATSAPP_TOKEN=x WHATSAPP_PHONE_ID=123 \\
+        OWNER_WA_NUMBER=910000000000 python server/app.py
+
+GET /stats returns request, error, throttle and callback counts.
+"""
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from collections import deque
+
+import requests
+from flask import Flask, request, jsonify
+
+logger = logging.getLogger("mock_whatsapp")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--webhook", help="Server webhook URL to send owner replies to (omit to disable)")
+    parser.add_argument("--latency-ms", type=float, default=150, help="mean API latency")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="latency standard deviation")
+    parser.add_argument("--upload-mbps", type=float, default=0, help="simulated media upload bandwidth (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls failing with HTTP 500")
+    parser.add_argument("--rate-limit", type=float, default=80, help="messages per second before 429 (0 = unlimited)")
+    parser.add_argument("--approve-rate", type=float, default=1.0, help="fraction of prompts the owner approves")
+    parser.add_argument("--reply-delay", type=float, default=1.0, help="seconds before the owner answers")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="fraction of webhook calls delivered twice")
+    return parser.parse_args(argv)
+
+
+class Limiter:
+    """Fixed-window counter mimicking Meta's per-second throughput cap."""
+
+    def __init__(self, per_second):
+        self.per_second = per_second
+        self._window = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if not self.per_second:
+            return True
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window, self._count = window, 0
+            self._count += 1
+            return self._count <= self.per_second
+
+
+def create_app(config):
+    """Build the mock Graph API app from parsed arguments."""
+    app = Flask("mock_whatsapp")
+    limiter = Limiter(config.rate_limit)
+    stats = {"requests": 0, "errors": 0, "throttled": 0, "messages": 0, "media": 0,
+             "media_bytes": 0, "callbacks": 0, "callback_errors": 0}
+    recent = deque(maxlen=200)
+    lock = threading.Lock()
+    callbacks = requests.Session()
+
+    def bump(key, n=1):
+        with lock:
+            stats[key] += n
+
+    def simulate_latency(extra=0.0):
+        delay = max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000 + extra
+        if delay:
+            time.sleep(delay)
+
+    def failure():
+        """Return an error response if this call should be throttled or fail."""
+        bump("requests")
+        if not limiter.allow():
+            bump("throttled")
+            return jsonify({"error": {"message": "(#130429) Rate limit hit", "code": 130429}}), 429, {"Retry-After": "1"}
+        if random.random() < config.error_rate:
+            bump("errors")
+            return jsonify({"error": {"message": "Service temporarily unavailable", "code": 2}}), 500
+        return None
+
+    def owner_replies(to, message_id, reply_ids, reply_type="button_reply"):
+        """Deliver the owner's answer to the server webhook, like Meta would."""
+        reply_id = reply_ids[0] if random.random() < config.approve_rate else reply_ids[-1]
+        body = {
+            "object": "whatsapp_business_account",
+            "entry": [{"id": "mock", "changes": [{"field": "messages", "value": {
+                "messaging_product": "whatsapp",
+                "metadata": {"phone_number_id": "mock"},
+                "messages": [{
+                    "from": to,
+                    "id": f"wamid.{uuid.uuid4().hex}",
+                    "timestamp": str(int(time.time())),
+                    "type": "interactive",
+                    "context": {"id": message_id},
+                    "interactive": {"type": reply_type, reply_type: {"id": reply_id, "title": reply_id}},
+                }],
+            }}]}],
+        }
+        deliveries = 2 if random.random() < config.duplicate_rate else 1
+        for _ in range(deliveries):
+            try:
+                callbacks.post(config.webhook, json=body, timeout=30).raise_for_status()
+                bump("callbacks")
+            except requests.RequestException as e:
+                bump("callback_errors")
+                logger.warning(f"Webhook callback failed: {e}")
+
+    @app.post("/<version>/<phone_id>/messages")
+    def messages(version, phone_id):
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return jsonify({"error": {"message": "Missing access token", "code": 190}}), 401
+        error = failure()
+        if error:
+            return error
+        simulate_latency()
+
+        payload = request.get_json(force=True)
+        message_id = f"wamid.{uuid.uuid4().hex}"
+        bump("messages")
+        with lock:
+            recent.append({"id": message_id, "to": payload.get("to"), "type": payload.get("type"),
+                           "payload": payload, "at": time.time()})
+
+        interactive = payload.get("interactive") or {}
+        if config.webhook and interactive.get("type") == "button":
+            reply_ids = [b["reply"]["id"] for b in interactive["action"]["buttons"]]
+            threading.Timer(config.reply_delay, owner_replies, (payload.get("to"), message_id, reply_ids)).start()
+        elif config.webhook and interactive.get("type") == "list":
+            for section in interactive["action"]["sections"]:
+                reply_ids = [r["id"] for r in section["rows"]]
+                threading.Timer(config.reply_delay, owner_replies,
+                                (payload.get("to"), message_id, reply_ids, "list_reply")).start()
+
+        return jsonify({
+            "messaging_product": "whatsapp",
+            "contacts": [{"input": payload.get("to"), "wa_id": payload.get("to")}],
+            "messages": [{"id": message_id}],
+        })
+
+    @app.post("/<version>/<phone_id>/media")
+    def media(version, phone_id):
+        if not request.headers.get("Authorization", "").startswith("Bearer "):
+            return jsonify({"error": {"message": "Missing access token", "code": 190}}), 401
+        error = failure()
+        if error:
+            return error
+
+        size = 0
+        upload = request.files.get("file")
+        if upload is not None:
+            while True:
+                chunk = upload.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                size += len(chunk)
+        bump("media")
+        bump("media_bytes", size)
+        simulate_latency(size / (config.upload_mbps * 1024 * 1024) if config.upload_mbps else 0.0)
+        return jsonify({"id": str(random.randint(10 ** 14, 10 ** 15 - 1))})
+
+    @app.get("/stats")
+    def get_stats():
+        with lock:
+            return jsonify(dict(stats))
+
+    @app.get("/messages")
+    def get_messages():
+        with lock:
+            return jsonify(list(recent))
+
+    return app
+
+
+def main():
+    config = parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    app = create_app(config)
+    logger.info(f"Mock WhatsApp Cloud API on http://{config.host}:{config.port} (webhook: {config.webhook})")
+    app.run(host=config.host, port=config.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Simulate many agents on /agent/stream/<machine_id>.
+
+Each simulated agent holds one event-stream connection, reconnecting with
+Last-Event-ID like ZorderAgent does. The driver creates approvals, approves
+them through the WhatsApp webhook, and measures how long each arm event took
+to reach its agent. With --drop-rate the agents randomly cut their connection
+after an event, to check that resume-from-last-event-id never loses one.
+
+By default the server runs in-process on a throwaway database:
+
+    python loadtest/simulate_agents.py --agents 200 --approvals 500
+
+or point it at a running server whose /event/bill-edited returns action ids:
+
+    python loadtest/simulate_agents.py --server http://127.0.0.1:8000
+"""
+import os
+import sys
+import time
+import json
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+
+import requests
+
+
+def start_local_server(owner):
+    """Run server/app.py in a background thread on a temp database; returns (url, app module)."""
+    tmp = tempfile.mkdtemp(prefix="zorder-sim-")
+    os.environ.setdefault("DB_PATH", os.path.join(tmp, "sim.db"))
+    os.environ.setdefault("UPLOAD_DIR", os.path.join(tmp, "uploads"))
+    os.environ.setdefault("OWNER_WA_NUMBER", owner)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))
+    import app as server_app
+    from werkzeug.serving import make_server
+
+    httpd = make_server("127.0.0.1", 0, server_app.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}", server_app
+
+
+class SimulatedAgent(threading.Thread):
+    """One agent following its machine's event stream."""
+
+    def __init__(self, server, machine_id, drop_rate, on_arm):
+        super().__init__(daemon=True)
+        self.server = server
+        self.machine_id = machine_id
+        self.drop_rate = drop_rate
+        self.on_arm = on_arm
+        self.last_event_id = None
+        self.reconnects = 0
+        self.stopped = False
+
+    def run(self):
+        session = requests.Session()
+        while not self.stopped:
+            headers = {"Accept": "text/event-stream"}
+            if self.last_event_id:
+                headers["Last-Event-ID"] = self.last_event_id
+            try:
+                with session.get(f"{self.server}/agent/stream/{self.machine_id}",
+                                 headers=headers, stream=True, timeout=(10, 60)) as response:
+                    event, data, event_id = None, [], None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self.stopped:
+                            return
+                        if line:
+                            field, _, value = line.partition(":")
+                            value = value[1:] if value.startswith(" ") else value
+                            if field == "event":
+                                event = value
+                            elif field == "data":
+                                data.append(value)
+                            elif field == "id":
+                                event_id = value
+                            continue
+                        if event == "arm":
+                            self.on_arm(self.machine_id, json.loads("\n".join(data))["id"])
+                        if event_id is not None:
+                            self.last_event_id = event_id
+                        dropped = event is not None and random.random() < self.drop_rate
+                        event, data, event_id = None, [], None
+                        if dropped:
+                            break
+            except requests.RequestException:
+                time.sleep(0.5)
+            self.reconnects += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--server", help="Base URL of a running server (default: start one in-process)")
+    parser.add_argument("--agents", type=int, default=50)
+    parser.add_argument("--approvals", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=50, help="approvals per second")
+    parser.add_argument("--drop-rate", type=float, default=0.2, help="chance an agent reconnects after an event")
+    parser.add_argument("--settle", type=float, default=10, help="seconds to wait for stragglers")
+    parser.add_argument("--owner", default="910000000000",
+                        help="WhatsApp number replies come from (the server's OWNER_WA_NUMBER)")
+    args = parser.parse_args()
+
+    server_app = None
+    if args.server:
+        server = args.server.rstrip("/")
+    else:
+        server, server_app = start_local_server(args.owner)
+    print(f"Server: {server}")
+
+    sent_at = {}
+    latencies = {}
+    lock = threading.Lock()
+
+    def on_arm(machine_id, action_id):
+        with lock:
+            if action_id in sent_at and action_id not in latencies:
+                latencies[action_id] = time.monotonic() - sent_at[action_id]
+
+    run_id = uuid.uuid4().hex[:6]
+    agents = [SimulatedAgent(server, f"SIM-{run_id}-{i}", args.drop_rate, on_arm) for i in range(args.agents)]
+    for agent in agents:
+        agent.start()
+    time.sleep(1)
+
+    http = requests.Session()
+    for n in range(args.approvals):
+        machine_id = random.choice(agents).machine_id
+        if server_app is not None:
+            # Insert directly: the in-process server has no WhatsApp credentials
+            action_id = str(uuid.uuid4())
+            server_app.db.execute(
+                "INSERT INTO approvals (id, invoice_id, biller_id, machine_id, admin_url, status, created_at) "
+                "VALUES (?,?,?,?,?,?,?)",
+                (action_id, f"SIM-{n}", "sim", machine_id, "", server_app.STATUS_PENDING, int(time.time())),
+            )
+        else:
+            r = http.post(f"{server}/event/bill-edited",
+                          json={"invoice_id": f"SIM-{n}", "biller_id": "sim", "machine_id": machine_id})
+            action_id = r.json().get("action_id")
+            if not action_id:
+                sys.exit(f"/event/bill-edited returned no action_id: HTTP {r.status_code} {r.text}")
+
+        with lock:
+            sent_at[action_id] = time.monotonic()
+        # Replies count only from the prompt's recipient, once per message id
+        http.post(f"{server}/webhook/whatsapp", json={"entry": [{"changes": [{"value": {"messages": [
+            {"from": args.owner, "id": f"wamid.{uuid.uuid4().hex}", "type": "interactive",
+             "interactive": {"button_reply": {"id": f"yes_{action_id}"}}}
+        ]}}]}]})
+        time.sleep(1 / args.rate)
+
+    deadline = time.monotonic() + args.settle
+    while time.monotonic() < deadline and len(latencies) < len(sent_at):
+        time.sleep(0.2)
+    for agent in agents:
+        agent.stopped = True
+
+    ms = [v * 1000 for v in latencies.values()]
+    print(f"Agents: {args.agents}  approvals: {len(sent_at)}  delivered: {len(latencies)}  "
+          f"missed: {len(sent_at) - len(latencies)}  reconnects: {sum(a.reconnects for a in agents)}")
+    if ms:
+        print(f"Arm latency ms  p50={percentile(ms, 50):.1f}  p95={percentile(ms, 95):.1f}  "
+              f"p99={percentile(ms, 99):.1f}  max={max(ms):.1f}")
+    sys.exit(0 if len(latencies) == len(sent_at) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,27 @@
 import os
+import math
+import time
 import uuid
-import sqlite3
 import datetime
-import mimetypes
 import json
 import logging
-from flask import Flask, request, jsonify
-import requests
+from urllib.parse import quote
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from dotenv import load_dotenv
 
+from db import Database, PoolExhausted, STATUS_PENDING, STATUS_ALLOWED, STATUS_DENIED, STATUS_EXPIRED, STATUS_NAMES
+from migrations import run_migrations
+from notify import MachineNotifier, ChangeWatcher
+from outbox import Outbox
+from whatsapp import WhatsAppClient, LIST_MAX_ROWS, wa_number
+from metrics import Registry
+from uploads import UploadSessions, UploadError, StreamingRequest
+from transcode import Transcoder, WHATSAPP_MAX_VIDEO_BYTES
+from blobstore import BlobStore
+from retention import RetentionSweeper
+from expiry import ApprovalSweeper
+from armcache import ArmCache
+
 # Load environment variables
 load_dotenv()
 
@@ -28,126 +41,450 @@ OWNER_WA_NUMBER = os.getenv("OWNER_WA_NUMBER")      # e.g., 91XXXXXXXXXX (withou
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "replace_me")
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
 
-# API endpoints for WhatsApp Cloud API
-if WHATSAPP_PHONE_ID:
-    MEDIA_UPLOAD_URL = f"https://graph.facebook.com/v21.0/{WHATSAPP_PHONE_ID}/media"
-    MESSAGES_URL = f"https://graph.facebook.com/v21.0/{WHATSAPP_PHONE_ID}/messages"
-else:
-    # set placeholders; app will error if you actually call WA without setting the envs
-    MEDIA_UPLOAD_URL = ""
-    MESSAGES_URL = ""
+# Resumable chunked uploads (/upload/sessions): suggested chunk size, largest
+# recording accepted, and how long an idle session is kept before it's dropped
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(512 * 1024 * 1024)))
+UPLOAD_SESSION_TTL_SECONDS = int(os.getenv("UPLOAD_SESSION_TTL_SECONDS", str(24 * 3600)))
+
+# Recording playback (/recordings/<id>): optionally hand file transfers, Range
+# requests included, to the front-end server. nginx: RECORDING_ACCEL_PREFIX is
+# an `internal` location aliased to UPLOAD_DIR (X-Accel-Redirect). Apache with
+# mod_xsendfile or lighttpd: USE_X_SENDFILE=1. Browser cache lifetime for the videos
+RECORDING_ACCEL_PREFIX = os.getenv("RECORDING_ACCEL_PREFIX", "")
+USE_X_SENDFILE = os.getenv("USE_X_SENDFILE", "0") == "1"
+RECORDING_CACHE_MAX_AGE = int(os.getenv("RECORDING_CACHE_MAX_AGE", "86400"))
+
+# Retention for stored recordings: byte quota and age limit (0 = off), optional
+# downscale-to-low-bitrate tier for old recordings, and eviction order once
+# over quota ("lru" = least recently played, or "oldest")
+RETENTION_QUOTA_BYTES = int(os.getenv("RETENTION_QUOTA_BYTES", "0"))
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_DOWNSCALE_AFTER_DAYS = float(os.getenv("RETENTION_DOWNSCALE_AFTER_DAYS", "0"))
+RETENTION_EVICTION = os.getenv("RETENTION_EVICTION", "lru")
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "300"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "50"))
+
+# WhatsApp keeps uploaded media for 30 days; a recording's media id is reused
+# for re-sends until shortly before that
+MEDIA_CACHE_TTL_SECONDS = int(os.getenv("MEDIA_CACHE_TTL_SECONDS", str(29 * 24 * 3600)))
+
+# Multipart uploads are streamed straight into UPLOAD_DIR; anything larger than
+# UPLOAD_MAX_BYTES (plus room for the form envelope) is refused up front
+app.request_class = StreamingRequest
+StreamingRequest.incoming_dir = os.path.join(UPLOAD_DIR, ".incoming")
+StreamingRequest.max_file_size = UPLOAD_MAX_BYTES
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 1024 * 1024
+
+# SQLite tuning (see db.py)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")
+
+# Long-polling: /tasks/<machine_id>?wait=N parks for at most this many seconds,
+# re-checking the database every LONGPOLL_RECHECK_SECONDS in case the change
+# was made by another worker process (event streams instead rely on one
+# watcher per process that polls on this interval)
+LONGPOLL_MAX_WAIT = float(os.getenv("LONGPOLL_MAX_WAIT", "30"))
+LONGPOLL_RECHECK_SECONDS = float(os.getenv("LONGPOLL_RECHECK_SECONDS", "5"))
+
+# Server-sent event stream (/agent/stream/<machine_id>): keepalive comment
+# interval, and how long one connection lives before the agent reconnects
+STREAM_HEARTBEAT_SECONDS = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+STREAM_MAX_SECONDS = float(os.getenv("STREAM_MAX_SECONDS", "300"))
+
+# Arm-state cache: /tasks and /agent/arm-status are answered from memory.
+# Each worker notices changes made by other workers within
+# ARM_CACHE_SYNC_SECONDS (0 = check on every request)
+ARM_CACHE = os.getenv("ARM_CACHE", "1") == "1"
+ARM_CACHE_SYNC_SECONDS = float(os.getenv("ARM_CACHE_SYNC_SECONDS", "1"))
+
+# Most machine ids one POST /tasks/batch may ask about
+TASKS_BATCH_MAX = int(os.getenv("TASKS_BATCH_MAX", "500"))
+
+# Task leases (/tasks/claim): how long a claimed task stays hidden from other
+# agents on the same machine unless renewed, and the longest lease an agent
+# may ask for
+TASK_LEASE_SECONDS = int(os.getenv("TASK_LEASE_SECONDS", "300"))
+TASK_LEASE_MAX_SECONDS = int(os.getenv("TASK_LEASE_MAX_SECONDS", "3600"))
+
+# Approval TTLs: pending approvals the owner doesn't answer and allowed ones no
+# agent uses expire after these many seconds (0 = never); finished approvals
+# move to approvals_history once unchanged for APPROVAL_ARCHIVE_AFTER_SECONDS;
+# approval_events rows are deleted after APPROVAL_EVENTS_TTL_SECONDS
+APPROVAL_PENDING_TTL_SECONDS = int(os.getenv("APPROVAL_PENDING_TTL_SECONDS", str(24 * 3600)))
+APPROVAL_ALLOWED_TTL_SECONDS = int(os.getenv("APPROVAL_ALLOWED_TTL_SECONDS", str(24 * 3600)))
+APPROVAL_ARCHIVE_AFTER_SECONDS = int(os.getenv("APPROVAL_ARCHIVE_AFTER_SECONDS", str(7 * 24 * 3600)))
+APPROVAL_EVENTS_TTL_SECONDS = int(os.getenv("APPROVAL_EVENTS_TTL_SECONDS", str(90 * 24 * 3600)))
+APPROVAL_SWEEP_SECONDS = float(os.getenv("APPROVAL_SWEEP_SECONDS", "60"))
+
+# Bulk bill edits (/event/bill-edited/bulk): most edits per request, and the
+# WhatsApp numbers besides OWNER_WA_NUMBER that an edit's `owner` may name
+BULK_MAX_EDITS = int(os.getenv("BULK_MAX_EDITS", "1000"))
+APPROVER_WA_NUMBERS = {
+    wa_number(n) for n in [OWNER_WA_NUMBER, *os.getenv("APPROVER_WA_NUMBERS", "").split(",")] if wa_number(n)
+}
+
+# Webhook idempotency: WhatsApp message ids already applied are remembered
+# this long (Meta retries failed deliveries for days) and at most this many
+WEBHOOK_DEDUPE_TTL_SECONDS = int(os.getenv("WEBHOOK_DEDUPE_TTL_SECONDS", str(7 * 24 * 3600)))
+WEBHOOK_DEDUPE_MAX = int(os.getenv("WEBHOOK_DEDUPE_MAX", "100000"))
+
+# Transcoding: recordings over WhatsApp's video limit (or over
+# TRANSCODE_TARGET_KBPS, 0 = no bitrate target) are re-encoded before sending,
+# at most TRANSCODE_WORKERS ffmpeg processes at a time per server process
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", "2"))
+TRANSCODE_MAX_BYTES = int(os.getenv("TRANSCODE_MAX_BYTES", str(WHATSAPP_MAX_VIDEO_BYTES)))
+TRANSCODE_TARGET_KBPS = int(os.getenv("TRANSCODE_TARGET_KBPS", "0"))
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "veryfast")
+
+# Metrics: set METRICS_DIR to a directory shared by all worker processes so
+# /metrics on any worker reports the whole server
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+
+# WhatsApp outbox: background delivery workers per process, retry policy
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+# Recordings get workers of their own so transcodes and media uploads never
+# delay approval prompts (0 = general workers deliver them too)
+OUTBOX_RECORDING_WORKERS = int(os.getenv("OUTBOX_RECORDING_WORKERS", "2"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+# Lease on a claimed message; the delivering worker renews it every third of
+# its length, so it only bounds how soon a crashed worker's message is retried.
+# Recordings get a longer one, since a transcode keeps the machine busy
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+OUTBOX_RECORDING_LEASE_SECONDS = int(os.getenv("OUTBOX_RECORDING_LEASE_SECONDS", "300"))
+
+# WhatsApp Cloud API client: base URL (point at a local stand-in for offline
+# runs), connection pool size and Meta's throughput limits
+WHATSAPP_API_BASE = os.getenv("WHATSAPP_API_BASE", "https://graph.facebook.com")
+WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION", "v21.0")
+WHATSAPP_POOL_SIZE = int(os.getenv("WHATSAPP_POOL_SIZE", "20"))
+WHATSAPP_RATE_PER_SECOND = float(os.getenv("WHATSAPP_RATE_PER_SECOND", "80"))
+WHATSAPP_PAIR_RATE_PER_SECOND = float(os.getenv("WHATSAPP_PAIR_RATE_PER_SECOND", str(1 / 6)))
+WHATSAPP_PAIR_BURST = int(os.getenv("WHATSAPP_PAIR_BURST", "45"))
 
 
 # -----------------------------
 # DB setup
 # -----------------------------
-def get_db_connection():
-    """Get database connection."""
-    return sqlite3.connect(DB)
+db = Database(
+    DB,
+    pool_size=DB_POOL_SIZE,
+    busy_timeout_ms=DB_BUSY_TIMEOUT_MS,
+    cache_size_kib=DB_CACHE_SIZE_KB,
+    synchronous=DB_SYNCHRONOUS,
+)
+
+
+# Wakes long-poll requests when a machine's approvals change
+notifier = MachineNotifier()
+# ...including changes made by other processes and leases that lapse
+change_watcher = ChangeWatcher(db, notifier, interval=LONGPOLL_RECHECK_SECONDS)
+
+# Per-machine arm state in memory, invalidated by approvals_changed()
+arm_cache = ArmCache(db, lambda machine_id: load_arm_state(machine_id), sync_interval=ARM_CACHE_SYNC_SECONDS)
+
+# Outgoing WhatsApp messages are queued here and delivered in the background
+outbox = Outbox(
+    db,
+    max_attempts=OUTBOX_MAX_ATTEMPTS,
+    backoff_base=OUTBOX_BACKOFF_BASE,
+    backoff_max=OUTBOX_BACKOFF_MAX,
+    lease_seconds=OUTBOX_LEASE_SECONDS,
+)
+
+
+# Chunked upload sessions; part files live next to the finished uploads so
+# finalizing is a rename
+uploads = UploadSessions(
+    db,
+    os.path.join(UPLOAD_DIR, ".sessions"),
+    chunk_size=UPLOAD_CHUNK_SIZE,
+    max_size=UPLOAD_MAX_BYTES,
+    ttl_seconds=UPLOAD_SESSION_TTL_SECONDS,
+)
+
+
+# Received recordings, stored by content hash
+blobs = BlobStore(os.path.join(UPLOAD_DIR, "blobs"))
+
 
 def init_db():
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS approvals (
-            id TEXT PRIMARY KEY,
-            invoice_id TEXT,
-            biller_id TEXT,
-            machine_id TEXT,
-            admin_url TEXT,
-            status TEXT,
-            created_at TEXT,
-            consumed INTEGER DEFAULT 0
-        )
-        """
+    version = run_migrations(db)
+    logger.info(f"Database schema at v{version}")
+
+
+def record_event(con, action_id, machine_id, event, data=None):
+    """Append an approval change to approval_events (inside the caller's transaction)."""
+    record_events(con, [(action_id, machine_id, event, data)])
+
+
+def record_events(con, events):
+    """Append many (action_id, machine_id, event, data) changes with one executemany."""
+    now = int(time.time())
+    con.executemany(
+        "INSERT INTO approval_events (action_id, machine_id, event, data, created_at) VALUES (?,?,?,?,?)",
+        [(a, m, e, json.dumps(d) if d else None, now) for a, m, e, d in events],
+    )
+
+
+def task_view(r):
+    return {"id": r["id"], "invoice_id": r["invoice_id"], "biller_id": r["biller_id"],
+            "admin_url": r["admin_url"], "status": STATUS_NAMES[r["status"]]}
+
+
+def load_arm_state(machine_id):
+    """Allowed, unconsumed approvals of a machine: (state, valid_until) for the arm cache.
+
+    The state holds the unleased tasks `/tasks` hands out and the newest
+    allowed approval `/agent/arm-status` reports; it stops being valid when
+    the first lease hiding one of the tasks lapses. Its `version` (the ETag of
+    both endpoints) is the machine's last approval event, which every change
+    to its approvals appends, plus the number of visible tasks, which also
+    moves when a lease lapses.
+    """
+    last_event = db.query_one("SELECT MAX(id) FROM approval_events WHERE machine_id=?", (machine_id,))[0] or 0
+    rows = db.query(
+        "SELECT id, invoice_id, biller_id, admin_url, status, created_at, lease_expires_at FROM approvals "
+        "WHERE machine_id=? AND status=? AND consumed=0 ORDER BY created_at DESC LIMIT 100",
+        (machine_id, STATUS_ALLOWED),
     )
-    con.commit()
-    con.close()
+    return build_arm_state(rows, last_event, int(time.time()))
+
+
+def build_arm_state(rows, last_event, now):
+    """Arm state from a machine's allowed, unconsumed approval rows (newest first)."""
+    leased = [r["lease_expires_at"] for r in rows if (r["lease_expires_at"] or 0) > now]
+    tasks = [task_view(r) for r in rows if (r["lease_expires_at"] or 0) <= now][:10]
+    state = {
+        "tasks": tasks,
+        "armed": {"id": rows[0]["id"], "created_at": rows[0]["created_at"]} if rows else None,
+        "version": f"{last_event}.{len(tasks)}",
+    }
+    return state, min(leased) if leased else None
+
+
+def arm_state(machine_id):
+    return arm_cache.get(machine_id) if ARM_CACHE else load_arm_state(machine_id)[0]
+
+
+def approvals_changed(machine_id):
+    """Call after committing a change to a machine's approvals: drops its cached
+    arm state and wakes its long-polls and event streams."""
+    arm_cache.invalidate(machine_id)
+    notifier.notify(machine_id)
+
+
+def iso(ts):
+    """Render an epoch timestamp from the database as ISO-8601 UTC."""
+    return datetime.datetime.fromtimestamp(ts, datetime.UTC).isoformat().replace("+00:00", "Z")
 
 
 init_db()
 
+# Expires stale approvals and archives finished ones in the background
+approval_sweeper = ApprovalSweeper(
+    db,
+    record_event,
+    pending_ttl=APPROVAL_PENDING_TTL_SECONDS,
+    allowed_ttl=APPROVAL_ALLOWED_TTL_SECONDS,
+    archive_after=APPROVAL_ARCHIVE_AFTER_SECONDS,
+    events_ttl=APPROVAL_EVENTS_TTL_SECONDS,
+    interval=APPROVAL_SWEEP_SECONDS,
+)
+approval_sweeper.on_expired = lambda machine_ids: [approvals_changed(m) for m in machine_ids]
+approval_sweeper.start()
+change_watcher.start()
+
 
 # -----------------------------
-# WhatsApp helpers
+# Metrics
 # -----------------------------
-def wa_headers():
-    return {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-    }
+metrics = Registry(metrics_dir=METRICS_DIR, flush_interval=METRICS_FLUSH_SECONDS)
+http_latency = metrics.histogram(
+    "zorder_http_request_duration_seconds", "HTTP request latency by route", ("route", "method", "status"))
+sqlite_latency = metrics.histogram(
+    "zorder_sqlite_duration_seconds", "SQLite read queries, write transactions and write-lock waits", ("op",))
+wa_latency = metrics.histogram(
+    "zorder_whatsapp_request_duration_seconds", "WhatsApp Cloud API call latency", ("endpoint",))
+wa_failures = metrics.counter(
+    "zorder_whatsapp_failures_total", "WhatsApp Cloud API errors and throttled calls", ("endpoint", "kind"))
+upload_bytes = metrics.counter("zorder_upload_bytes_total", "Recording bytes received")
+transcode_latency = metrics.histogram(
+    "zorder_transcode_duration_seconds", "Wall time of recording re-encodes", ("passes",),
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+retention_files = metrics.counter(
+    "zorder_retention_recordings_total", "Recordings deleted or downscaled by retention", ("reason",))
+retention_bytes = metrics.counter(
+    "zorder_retention_reclaimed_bytes_total", "Disk space reclaimed by retention", ("reason",))
+arm_cache_lookups = metrics.counter(
+    "zorder_arm_cache_lookups_total", "Arm-state lookups served from memory (hit) or SQLite (miss)", ("result",))
+transcode_speed = metrics.histogram(
+    "zorder_transcode_speed_ratio", "Seconds of video encoded per wall-clock second", ("passes",),
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 16, 32, 64))
 
 
-def wa_send_text(text: str, to: str = None):
-    to = to or OWNER_WA_NUMBER
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_ID and to):
-        raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID/OWNER_WA_NUMBER)")
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "text",
-        "text": {"body": text},
-    }
-    r = requests.post(MESSAGES_URL, headers={**wa_headers(), "Content-Type": "application/json"}, json=payload, timeout=20)
-    r.raise_for_status()
-    return r.json()
-
-
-def wa_send_buttons(text: str, action_id: str, to: str = None):
-    to = to or OWNER_WA_NUMBER
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_ID and to):
-        raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID/OWNER_WA_NUMBER)")
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "interactive",
-        "interactive": {
-            "type": "button",
-            "body": {"text": text},
-            "action": {
-                "buttons": [
-                    {"type": "reply", "reply": {"id": f"yes_{action_id}", "title": "YES"}},
-                    {"type": "reply", "reply": {"id": f"no_{action_id}", "title": "NO"}},
-                ]
-            },
-        },
-    }
-    r = requests.post(MESSAGES_URL, headers={**wa_headers(), "Content-Type": "application/json"}, json=payload, timeout=20)
-    r.raise_for_status()
-    return r.json()
-
-
-def wa_upload_media(file_path: str, mime: str = None):
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_ID):
-        raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID)")
-    mime = mime or mimetypes.guess_type(file_path)[0] or "video/mp4"
-    files = {
-        "file": (os.path.basename(file_path), open(file_path, "rb"), mime),
-        "messaging_product": (None, "whatsapp"),
-    }
-    r = requests.post(MEDIA_UPLOAD_URL, headers=wa_headers(), files=files, timeout=90)
-    r.raise_for_status()
-    return r.json()["id"]
-
-
-def wa_send_media(media_id: str, caption: str, to: str = None):
-    to = to or OWNER_WA_NUMBER
-    if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_ID and to):
-        raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID/OWNER_WA_NUMBER)")
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to,
-        "type": "video",
-        "video": {"id": media_id, "caption": caption[:1024]},
-    }
-    r = requests.post(MESSAGES_URL, headers={**wa_headers(), "Content-Type": "application/json"}, json=payload, timeout=30)
-    r.raise_for_status()
-    return r.json()
+def observe_whatsapp(endpoint, seconds, error, throttled):
+    wa_latency.observe(seconds, endpoint)
+    if error:
+        wa_failures.inc(endpoint, "error")
+    if throttled:
+        wa_failures.inc(endpoint, "throttled")
+
+
+def observe_transcode(seconds, media_seconds, passes):
+    transcode_latency.observe(seconds, str(passes))
+    transcode_speed.observe(media_seconds / seconds if seconds else 0.0, str(passes))
+
+
+def observe_retention(reason, files, reclaimed):
+    retention_files.inc(reason, amount=files)
+    retention_bytes.inc(reason, amount=reclaimed)
+
+
+def approval_counts():
+    rows = db.query("SELECT status, consumed, COUNT(*) AS n FROM approvals GROUP BY status, consumed")
+    counts = {}
+    for r in rows:
+        state = "consumed" if r["consumed"] else STATUS_NAMES.get(r["status"], str(r["status"]))
+        counts[(state,)] = counts.get((state,), 0) + r["n"]
+    return counts
+
+
+db.observer = lambda op, seconds: sqlite_latency.observe(seconds, op)
+arm_cache.observer = lambda hit: arm_cache_lookups.inc("hit" if hit else "miss")
+metrics.gauge("zorder_approvals", "Approvals by state", ("state",), approval_counts)
+metrics.gauge("zorder_outbox_messages", "Outbox messages by status", ("status",),
+              lambda: {(k,): v for k, v in outbox.depth().items()})
+metrics.start_flusher()
+
+
+# -----------------------------
+# WhatsApp client
+# -----------------------------
+wa = WhatsAppClient(
+    WHATSAPP_TOKEN,
+    WHATSAPP_PHONE_ID,
+    owner=OWNER_WA_NUMBER,
+    api_base=WHATSAPP_API_BASE,
+    api_version=WHATSAPP_API_VERSION,
+    rate_per_second=WHATSAPP_RATE_PER_SECOND,
+    pair_rate_per_second=WHATSAPP_PAIR_RATE_PER_SECOND,
+    pair_burst=WHATSAPP_PAIR_BURST,
+    pool_size=WHATSAPP_POOL_SIZE,
+)
+wa.observer = observe_whatsapp
+
+outbox.register("text", lambda p: wa.send_text(p["text"], p.get("to")))
+outbox.register("buttons", lambda p: wa.send_buttons(p["text"], p["action_id"], p.get("to")))
+
+
+def approval_sections(edits):
+    """List-message sections for a batch of edits: one per bill, with Allow and Reject rows."""
+    return [
+        {
+            "title": f"Bill {e['invoice_id']}"[:24],
+            "rows": [
+                {"id": f"yes_{e['action_id']}", "title": "✅ Allow",
+                 "description": f"Biller {e['biller_id']} · {e['machine_id']}"[:72]},
+                {"id": f"no_{e['action_id']}", "title": "❌ Reject",
+                 "description": f"Biller {e['biller_id']} · {e['machine_id']}"[:72]},
+            ],
+        }
+        for e in edits
+    ]
+
+
+outbox.register("approval_list", lambda p: wa.send_list(p["text"], "Review", approval_sections(p["edits"]), p.get("to")))
+
+
+transcoder = Transcoder(
+    workers=TRANSCODE_WORKERS,
+    max_bytes=TRANSCODE_MAX_BYTES,
+    target_kbps=TRANSCODE_TARGET_KBPS,
+    preset=TRANSCODE_PRESET,
+)
+transcoder.observer = observe_transcode
+
+retention = RetentionSweeper(
+    db,
+    os.path.join(UPLOAD_DIR, ".retention.lock"),
+    quota_bytes=RETENTION_QUOTA_BYTES,
+    max_age_seconds=int(RETENTION_MAX_AGE_DAYS * 86400),
+    downscale_after_seconds=int(RETENTION_DOWNSCALE_AFTER_DAYS * 86400),
+    transcoder=transcoder,
+    eviction=RETENTION_EVICTION,
+    batch_size=RETENTION_BATCH_SIZE,
+    interval=RETENTION_INTERVAL_SECONDS,
+)
+retention.observer = observe_retention
+metrics.gauge("zorder_recordings_stored_bytes", "Bytes of recordings currently stored", (),
+              lambda: {(): retention.usage()})
+retention.start()
+
+
+def cached_media_id(sha256):
+    """WhatsApp media id of an earlier upload of this content, if still valid."""
+    row = db.query_one(
+        "SELECT media_id FROM media_cache WHERE sha256=? AND expires_at>?", (sha256, int(time.time()))
+    )
+    return row["media_id"] if row else None
+
+
+def cache_media_id(sha256, media_id):
+    now = int(time.time())
+    db.execute(
+        "INSERT OR REPLACE INTO media_cache (sha256, media_id, expires_at, created_at) VALUES (?,?,?,?)",
+        (sha256, media_id, now + MEDIA_CACHE_TTL_SECONDS, now),
+    )
+
+
+def deliver_recording(payload):
+    """Outbox handler: fit the recording under WhatsApp's limit, upload it, then send it."""
+    # Each step is checkpointed in the payload by the outbox, so a retry
+    # neither re-encodes nor re-uploads; across jobs, the same content reuses
+    # its cached media id
+    sha256 = payload.get("sha256")
+    if not payload.get("media_id") and sha256:
+        payload["media_id"] = cached_media_id(sha256)
+    if not payload.get("media_id"):
+        if not payload.get("send_path"):
+            payload["send_path"] = transcoder.fit(payload["path"])
+        payload["media_id"] = wa.upload_media(payload["send_path"], mime="video/mp4")
+        if sha256:
+            cache_media_id(sha256, payload["media_id"])
+    return wa.send_media(payload["media_id"], payload["caption"], payload.get("to"))
+
+
+outbox.register("recording", deliver_recording, pool="recording", lease_seconds=OUTBOX_RECORDING_LEASE_SECONDS)
+outbox.start(OUTBOX_WORKERS, {"recording": OUTBOX_RECORDING_WORKERS})
 
 
 # -----------------------------
 # Routes
 # -----------------------------
+@app.before_request
+def before_request():
+    g.started = time.perf_counter()
+    # Under a pre-forking server the threads started at import belong to the parent
+    outbox.ensure_running()
+    metrics.start_flusher()
+    retention.start()
+    approval_sweeper.start()
+    change_watcher.start()
+
+
+@app.after_request
+def after_request(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    http_latency.observe(time.perf_counter() - g.get("started", time.perf_counter()), route, request.method, str(response.status_code))
+    return response
+
+
 @app.get("/")
 def root():
     return {"ok": True, "service": "zorder-backend", "version": "1.1.0"}
@@ -158,6 +495,11 @@ def healthz():
     return "ok"
 
 
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @app.post("/event/bill-edited")
 def bill_edited():
     data = request.get_json(force=True)
@@ -167,30 +509,98 @@ def bill_edited():
 
     admin_url = data.get("admin_url", "")
     action_id = str(uuid.uuid4())
-    now = datetime.datetime.now(datetime.UTC).isoformat() + "Z"
+    now = int(time.time())
 
     logger.info(f"Processing bill edit request: invoice={data['invoice_id']}, biller={data['biller_id']}, machine={data['machine_id']}")
 
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO approvals (id, invoice_id, biller_id, machine_id, admin_url, status, created_at) VALUES (?,?,?,?,?,?,?)",
-        (action_id, data["invoice_id"], data["biller_id"], data["machine_id"], admin_url, "pending", now),
-    )
-    con.commit()
-    con.close()
-
     text = (
         f"Biller {data['biller_id']} ne bill {data['invoice_id']} edit kiya.\n"
         f"Auto-login + 3 min screen recording allow karen?"
     )
 
-    try:
-        wa_send_buttons(text, action_id)
-    except Exception as e:
-        return {"error": "whatsapp_send_failed", "details": str(e)}, 500
+    # The approval and its WhatsApp prompt commit together; delivery happens in the background
+    with db.transaction() as con:
+        con.execute(
+            "INSERT INTO approvals (id, invoice_id, biller_id, machine_id, admin_url, status, created_at, updated_at) "
+            "VALUES (?,?,?,?,?,?,?,?)",
+            (action_id, data["invoice_id"], data["biller_id"], data["machine_id"], admin_url, STATUS_PENDING, now, now),
+        )
+        record_event(con, action_id, data["machine_id"], "created",
+                     {"invoice_id": data["invoice_id"], "biller_id": data["biller_id"], "admin_url": admin_url})
+        message_id = outbox.enqueue("buttons", {"text": text, "action_id": action_id}, con=con)
+    outbox.wake()
+
+    return {"ok": True, "action_id": action_id, "message_id": message_id}
+
+
+@app.post("/event/bill-edited/bulk")
+def bill_edited_bulk():
+    """Many bill edits in one request: {edits: [{invoice_id, biller_id, machine_id, admin_url?, owner?}, ...]}.
+
+    All approvals are inserted in one transaction. Instead of one button
+    prompt per edit, each owner (`owner` is a WhatsApp number from
+    APPROVER_WA_NUMBERS, default OWNER_WA_NUMBER) gets list messages of up to
+    LIST_MAX_ROWS / 2 edits, each edit with its own Allow and Reject rows.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    edits = data.get("edits")
+    if not isinstance(edits, list) or not edits:
+        return {"error": "edits must be a non-empty list"}, 400
+    if len(edits) > BULK_MAX_EDITS:
+        return {"error": f"at most {BULK_MAX_EDITS} edits per request"}, 400
+    for i, edit in enumerate(edits):
+        if not isinstance(edit, dict):
+            return {"error": f"edits[{i}] must be an object"}, 400
+        for k in ("invoice_id", "biller_id", "machine_id"):
+            if k not in edit:
+                return {"error": f"edits[{i}]: missing {k}"}, 400
+        # Whoever the prompt goes to can allow an auto-login, so callers may
+        # only pick among the configured approvers
+        if edit.get("owner") and wa_number(edit["owner"]) not in APPROVER_WA_NUMBERS:
+            return {"error": f"edits[{i}]: owner is not a configured approver"}, 400
 
-    return {"ok": True, "action_id": action_id}
+    now = int(time.time())
+    rows, by_owner = [], {}
+    for edit in edits:
+        action_id = str(uuid.uuid4())
+        owner = wa_number(edit["owner"]) if edit.get("owner") else None
+        rows.append((action_id, edit["invoice_id"], edit["biller_id"], edit["machine_id"],
+                     edit.get("admin_url", ""), STATUS_PENDING, owner, now, now))
+        by_owner.setdefault(owner, []).append({
+            "action_id": action_id, "invoice_id": str(edit["invoice_id"]),
+            "biller_id": str(edit["biller_id"]), "machine_id": str(edit["machine_id"]),
+        })
+
+    logger.info(f"Processing {len(rows)} bill edits for {len(by_owner)} owner(s)")
+
+    per_message = LIST_MAX_ROWS // 2
+    message_ids = []
+    with db.transaction() as con:
+        con.executemany(
+            "INSERT INTO approvals (id, invoice_id, biller_id, machine_id, admin_url, status, approver, "
+            "created_at, updated_at) VALUES (?,?,?,?,?,?,?,?,?)",
+            rows,
+        )
+        record_events(con, [
+            (r[0], r[3], "created", {"invoice_id": r[1], "biller_id": r[2], "admin_url": r[4]}) for r in rows
+        ])
+        for owner, pending in by_owner.items():
+            for start in range(0, len(pending), per_message):
+                chunk = pending[start:start + per_message]
+                if len(chunk) == 1:
+                    e = chunk[0]
+                    text = (f"Biller {e['biller_id']} ne bill {e['invoice_id']} edit kiya.\n"
+                            f"Auto-login + 3 min screen recording allow karen?")
+                    payload = {"text": text, "action_id": e["action_id"], "to": owner}
+                    message_ids.append(outbox.enqueue("buttons", payload, con=con))
+                    continue
+                text = (f"{len(chunk)} bills edit hue.\n"
+                        + "\n".join(f"• Biller {e['biller_id']}: bill {e['invoice_id']}" for e in chunk)
+                        + "\nAuto-login + 3 min screen recording allow karen? Har bill alag se chunen.")
+                message_ids.append(outbox.enqueue("approval_list", {"text": text, "edits": chunk, "to": owner}, con=con))
+    outbox.wake()
+
+    return {"ok": True, "action_ids": [r[0] for r in rows], "message_ids": message_ids}
 
 
 # WhatsApp webhook verification (GET)
@@ -201,78 +611,447 @@ def verify_webhook():
     return "Forbidden", 403
 
 
+CONFIRMATIONS = {
+    STATUS_ALLOWED: "✅ Approved. Agent armed for next login (F5/F6).",
+    STATUS_DENIED: "❌ Request rejected. Agent will not run.",
+}
+
+
+def parse_button_replies(payload):
+    """Extract (message_id, action_id, status, sender) for every YES/NO reply in a webhook payload.
+
+    Replies are button taps on a single prompt or row picks from a bulk list message.
+    """
+    replies = []
+    for entry in payload.get("entry", []):
+        for change in entry.get("changes", []):
+            for msg in change.get("value", {}).get("messages", []):
+                if msg.get("type") != "interactive":
+                    continue
+                interactive = msg.get("interactive", {})
+                reply = interactive.get("button_reply") or interactive.get("list_reply") or {}
+                rid = reply.get("id", "")
+                if rid.startswith("yes_"):
+                    status = STATUS_ALLOWED
+                elif rid.startswith("no_"):
+                    status = STATUS_DENIED
+                else:
+                    continue
+                replies.append((msg.get("id"), rid.split("_", 1)[1], status, msg.get("from")))
+    return replies
+
+
+_webhook_pruned_at = 0
+
+
+def prune_webhook_messages():
+    """Keep the webhook idempotency store bounded by age and row count (one batch at a time)."""
+    global _webhook_pruned_at
+    now = int(time.time())
+    if now - _webhook_pruned_at < 60:
+        return
+    _webhook_pruned_at = now
+    with db.transaction() as con:
+        con.execute(
+            "DELETE FROM webhook_messages WHERE message_id IN ("
+            "SELECT message_id FROM webhook_messages WHERE received_at < ? ORDER BY received_at LIMIT 1000)",
+            (now - WEBHOOK_DEDUPE_TTL_SECONDS,),
+        )
+        con.execute(
+            "DELETE FROM webhook_messages WHERE message_id IN ("
+            "SELECT message_id FROM webhook_messages ORDER BY received_at DESC LIMIT 1000 OFFSET ?)",
+            (WEBHOOK_DEDUPE_MAX,),
+        )
+
+
 # WhatsApp webhook receiver (POST)
 @app.post("/webhook/whatsapp")
 def whatsapp_webhook():
-    payload = request.get_json(force=True)
+    """Apply the owner's YES/NO replies.
+
+    A reply counts only from the number its prompt went to. Meta redelivers webhooks it thinks failed, so every WhatsApp message id is
+    recorded in webhook_messages and applied at most once. All replies in a
+    payload commit in one transaction together with their confirmation texts
+    (delivered later by the outbox), keeping the response fast during bursts.
+    """
+    payload = request.get_json(force=True, silent=True) or {}
     try:
-        for entry in payload.get("entry", []):
-            for change in entry.get("changes", []):
-                value = change.get("value", {})
-                for msg in value.get("messages", []):
-                    if msg.get("type") == "interactive":
-                        reply = msg["interactive"].get("button_reply") or {}
-                        rid = reply.get("id", "")
-                        if not rid:
-                            continue
-                        status = None
-                        if rid.startswith("yes_"):
-                            status = "allowed"
-                        elif rid.startswith("no_"):
-                            status = "denied"
-                        if status is None:
-                            continue
-                        action_id = rid.split("_", 1)[1]
-                        con = sqlite3.connect(DB)
-                        cur = con.cursor()
-                        cur.execute("UPDATE approvals SET status=? WHERE id=?", (status, action_id))
-                        con.commit()
-                        con.close()
-                        if status == "denied":
-                            try:
-                                wa_send_text("❌ Request rejected. Agent will not run.")
-                            except Exception:
-                                pass
-                        else:
-                            try:
-                                wa_send_text("✅ Approved. Agent armed for next login (F5/F6).")
-                            except Exception:
-                                pass
+        replies = parse_button_replies(payload)
     except Exception as e:
-        print("webhook parse error:", e)
+        logger.warning(f"webhook parse error: {e}")
+        return "ok"
+    if not replies:
+        return "ok"
+
+    now = int(time.time())
+    changed_machines = set()
+    with db.transaction() as con:
+        for message_id, action_id, status, sender in replies:
+            if message_id and not con.execute(
+                "INSERT OR IGNORE INTO webhook_messages (message_id, received_at) VALUES (?,?)",
+                (message_id, now),
+            ).rowcount:
+                continue  # redelivery of a reply we already applied
+            row = con.execute(
+                "SELECT machine_id, status, consumed, approver FROM approvals WHERE id=?", (action_id,)
+            ).fetchone()
+            if not row or row["consumed"] or row["status"] in (status, STATUS_EXPIRED):
+                continue
+            approver = wa_number(row["approver"] or OWNER_WA_NUMBER)
+            if not approver or wa_number(sender) != approver:
+                logger.warning(f"Ignoring reply to {action_id} from {sender}: not the approver")
+                continue
+            con.execute("UPDATE approvals SET status=?, updated_at=? WHERE id=?", (status, now, action_id))
+            record_event(con, action_id, row["machine_id"], STATUS_NAMES[status], {"by": sender})
+            # Confirm to whoever answered (bulk edits may go to several owners)
+            outbox.enqueue("text", {"text": CONFIRMATIONS[status], "to": sender}, con=con)
+            changed_machines.add(row["machine_id"])
+
+    for machine_id in changed_machines:
+        approvals_changed(machine_id)
+    if changed_machines:
+        outbox.wake()
+    prune_webhook_messages()
     return "ok"
 
 
+def long_poll_wait(value):
+    """A client's wait, in seconds within [0, LONGPOLL_MAX_WAIT]; unparsable, NaN or infinite means 0."""
+    try:
+        wait = float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+    if not math.isfinite(wait):
+        return 0.0
+    return min(max(wait, 0.0), LONGPOLL_MAX_WAIT)
+
+
+def armed_tasks(machine_id):
+    """Allowed, unconsumed approvals for a machine that no agent holds a lease on, newest first."""
+    return arm_state(machine_id)["tasks"]
+
+
 @app.get("/tasks/<machine_id>")
 def tasks(machine_id):
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.execute(
-        "SELECT id, invoice_id, biller_id, admin_url, status FROM approvals "
-        "WHERE machine_id=? AND status='allowed' AND consumed=0 ORDER BY created_at DESC LIMIT 10",
-        (machine_id,),
-    )
-    rows = cur.fetchall()
-    con.close()
-    return jsonify([
-        {"id": r[0], "invoice_id": r[1], "biller_id": r[2], "admin_url": r[3], "status": r[4]} for r in rows
-    ])
+    """List armed tasks; with ?wait=N, park up to N seconds until one appears.
+
+    The response carries the machine's arm-state version as its ETag. With
+    If-None-Match, the request instead parks until the state differs from
+    that version, and answers 304 if it never does.
+    """
+    wait = long_poll_wait(request.args.get("wait"))
+    seen = request.if_none_match
+    deadline = time.monotonic() + wait
+    while True:
+        # Read the version before querying so a change in between isn't missed
+        since = notifier.version(machine_id)
+        state = arm_state(machine_id)
+        unchanged = seen.contains(state["version"])
+        remaining = deadline - time.monotonic()
+        if (not unchanged if seen else state["tasks"]) or remaining <= 0:
+            if unchanged:
+                return "", 304, {"ETag": f'"{state["version"]}"'}
+            return jsonify(state["tasks"]), 200, {"ETag": f'"{state["version"]}"'}
+        notifier.wait(machine_id, since, min(remaining, LONGPOLL_RECHECK_SECONDS))
+
+
+def requested_lease(data):
+    """Lease length asked for in a claim/renew body, clamped to TASK_LEASE_MAX_SECONDS."""
+    try:
+        seconds = float(data.get("lease_seconds") or TASK_LEASE_SECONDS)
+    except (TypeError, ValueError):
+        seconds = TASK_LEASE_SECONDS
+    if not math.isfinite(seconds):
+        seconds = TASK_LEASE_SECONDS
+    return int(min(max(seconds, 10), TASK_LEASE_MAX_SECONDS))
+
+
+def claim_task(machine_id, owner, seconds):
+    """Lease the newest unleased allowed task of a machine to `owner`, or return None.
+
+    The pick and the lease happen in one write transaction, so two agents
+    claiming at once never get the same task.
+    """
+    now = int(time.time())
+    token = str(uuid.uuid4())
+    with db.transaction() as con:
+        row = con.execute(
+            "SELECT id, invoice_id, biller_id, admin_url, status FROM approvals "
+            "WHERE machine_id=? AND status=? AND consumed=0 AND (lease_expires_at IS NULL OR lease_expires_at<=?) "
+            "ORDER BY created_at DESC LIMIT 1",
+            (machine_id, STATUS_ALLOWED, now),
+        ).fetchone()
+        if row is None:
+            return None
+        con.execute(
+            "UPDATE approvals SET lease_token=?, lease_owner=?, lease_expires_at=?, updated_at=? WHERE id=?",
+            (token, owner, now + seconds, now, row["id"]),
+        )
+        record_event(con, row["id"], machine_id, "claimed", {"owner": owner, "lease_expires_at": iso(now + seconds)})
+    task = task_view(row)
+    task["lease"] = {"token": token, "owner": owner, "seconds": seconds, "expires_at": iso(now + seconds)}
+    return task
+
+
+@app.post("/tasks/batch")
+def tasks_batch():
+    """Armed tasks of many machines at once: {machine_ids: [...], since?: cursor}.
+
+    For gateways that front many billing PCs. Uses a fixed number of indexed
+    `IN` lookups however many machines are asked for. The response's `cursor`
+    can be passed back as `since`; the answer then holds only the machines
+    whose arm state changed after it (an approval event, or a lapsed lease).
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    machine_ids = data.get("machine_ids")
+    if not isinstance(machine_ids, list) or not all(isinstance(m, str) for m in machine_ids):
+        return {"error": "machine_ids must be a list of strings"}, 400
+    machine_ids = list(dict.fromkeys(machine_ids))
+    if len(machine_ids) > TASKS_BATCH_MAX:
+        return {"error": f"at most {TASKS_BATCH_MAX} machine_ids per request"}, 400
+
+    # Cursor "<event id>:<epoch>" is taken before reading, so a change that
+    # lands mid-request is reported again next time rather than missed
+    since = data.get("since")
+    since_event = since_time = None
+    if since:
+        event, sep, at = str(since).partition(":")
+        if not (sep and event.isdigit() and at.isdigit()):
+            return {"error": "since must be a cursor from an earlier response (<event id>:<epoch>)"}, 400
+        since_event, since_time = int(event), int(at)
+
+    now = int(time.time())
+    cursor = db.query_one("SELECT MAX(id) FROM approval_events")[0] or 0
+
+    if machine_ids and since_event is not None:
+        marks = ",".join("?" * len(machine_ids))
+        changed = {r[0] for r in db.query(
+            f"SELECT DISTINCT machine_id FROM approval_events WHERE id>? AND machine_id IN ({marks})",
+            (since_event, *machine_ids),
+        )}
+        changed |= {r[0] for r in db.query(
+            f"SELECT DISTINCT machine_id FROM approvals WHERE machine_id IN ({marks}) AND status=? AND consumed=0 "
+            "AND lease_expires_at>? AND lease_expires_at<=?",
+            (*machine_ids, STATUS_ALLOWED, since_time, now),
+        )}
+        machine_ids = [m for m in machine_ids if m in changed]
+
+    machines = {}
+    if machine_ids:
+        marks = ",".join("?" * len(machine_ids))
+        last_events = dict(db.query(
+            f"SELECT machine_id, MAX(id) FROM approval_events WHERE machine_id IN ({marks}) GROUP BY machine_id",
+            machine_ids,
+        ))
+        rows = {}
+        for r in db.query(
+            "SELECT machine_id, id, invoice_id, biller_id, admin_url, status, created_at, lease_expires_at "
+            f"FROM approvals WHERE machine_id IN ({marks}) AND status=? AND consumed=0 "
+            "ORDER BY machine_id, created_at DESC",
+            (*machine_ids, STATUS_ALLOWED),
+        ):
+            rows.setdefault(r["machine_id"], []).append(r)
+        for machine_id in machine_ids:
+            state, _ = build_arm_state(rows.get(machine_id, []), last_events.get(machine_id, 0), now)
+            machines[machine_id] = {"tasks": state["tasks"], "version": state["version"]}
+    return {"machines": machines, "cursor": f"{cursor}:{now}"}
+
+
+@app.post("/tasks/claim")
+def claim():
+    """Claim a task under a lease: {machine_id, owner?, lease_seconds?, wait?}.
+
+    Returns the task with its lease token, or 204 if there is none (after
+    parking up to `wait` seconds, like GET /tasks/<machine_id>?wait=N). A
+    claimed task is hidden from other agents until the lease expires, is
+    released, or the task is consumed.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    machine_id = data.get("machine_id")
+    if not machine_id:
+        return {"error": "missing machine_id"}, 400
+    owner = str(data.get("owner") or request.remote_addr or "")
+    seconds = requested_lease(data)
+    wait = long_poll_wait(data.get("wait"))
+    deadline = time.monotonic() + wait
+    while True:
+        since = notifier.version(machine_id)
+        task = claim_task(machine_id, owner, seconds)
+        if task:
+            approvals_changed(machine_id)
+            logger.info(f"Task {task['id']} claimed by {owner} for {seconds}s")
+            return task
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return "", 204
+        notifier.wait(machine_id, since, min(remaining, LONGPOLL_RECHECK_SECONDS))
+
+
+@app.post("/tasks/renew")
+def renew():
+    """Extend a lease: {id, lease_token, lease_seconds?}. 409 if the lease was lost."""
+    data = request.get_json(force=True, silent=True) or {}
+    if not data.get("id") or not data.get("lease_token"):
+        return {"error": "missing id or lease_token"}, 400
+    seconds = requested_lease(data)
+    now = int(time.time())
+    expires_at = now + seconds
+    with db.transaction() as con:
+        # A lapsed lease nobody else picked up still carries our token, so it renews
+        row = con.execute(
+            "SELECT machine_id, lease_owner, lease_expires_at FROM approvals "
+            "WHERE id=? AND lease_token=? AND status=? AND consumed=0",
+            (data["id"], data["lease_token"], STATUS_ALLOWED),
+        ).fetchone()
+        lapsed = row is not None and row["lease_expires_at"] <= now
+        if row:
+            con.execute("UPDATE approvals SET lease_expires_at=? WHERE id=?", (expires_at, data["id"]))
+        # Extending a live lease changes nothing anyone can see; only taking
+        # back a lapsed one hides the task again, so only that is an event
+        if lapsed:
+            record_event(con, data["id"], row["machine_id"], "renewed",
+                         {"owner": row["lease_owner"], "lease_expires_at": iso(expires_at)})
+    if not row:
+        return {"error": "lease_lost"}, 409
+    if lapsed:
+        approvals_changed(row["machine_id"])
+    return {"ok": True, "expires_at": iso(expires_at)}
+
+
+@app.post("/tasks/release")
+def release():
+    """Give a claimed task back unused: {id, lease_token}. Other agents can claim it at once."""
+    data = request.get_json(force=True, silent=True) or {}
+    if not data.get("id") or not data.get("lease_token"):
+        return {"error": "missing id or lease_token"}, 400
+    with db.transaction() as con:
+        row = con.execute(
+            "SELECT machine_id FROM approvals WHERE id=? AND lease_token=?", (data["id"], data["lease_token"])
+        ).fetchone()
+        if row:
+            con.execute(
+                "UPDATE approvals SET lease_token=NULL, lease_owner=NULL, lease_expires_at=NULL, updated_at=? "
+                "WHERE id=?",
+                (int(time.time()), data["id"]),
+            )
+            record_event(con, data["id"], row["machine_id"], "released")
+    if not row:
+        return {"error": "lease_lost"}, 409
+    approvals_changed(row["machine_id"])
+    return {"ok": True}
 
 
 @app.post("/tasks/consume")
 def consume():
+    """Mark a task done: {id, lease_token?}.
+
+    Refused with 409 while another agent holds a live lease on the task, so
+    only the lease holder (or anyone, once no lease is live) can consume it.
+    """
     data = request.get_json(force=True)
     action_id = data.get("id")
     if not action_id:
         return {"error": "missing id"}, 400
-    con = sqlite3.connect(DB)
-    cur = con.cursor()
-    cur.execute("UPDATE approvals SET consumed=1 WHERE id=?", (action_id,))
-    con.commit()
-    con.close()
+    now = int(time.time())
+    with db.transaction() as con:
+        row = con.execute(
+            "SELECT machine_id, lease_token, lease_owner, lease_expires_at FROM approvals WHERE id=?", (action_id,)
+        ).fetchone()
+        if (row and row["lease_token"] and row["lease_expires_at"] > now
+                and row["lease_token"] != data.get("lease_token")):
+            return {"error": "leased_by_another_agent"}, 409
+        if row:
+            con.execute(
+                "UPDATE approvals SET consumed=1, lease_token=NULL, lease_owner=NULL, lease_expires_at=NULL, "
+                "updated_at=? WHERE id=?",
+                (now, action_id),
+            )
+            record_event(con, action_id, row["machine_id"], "consumed",
+                         {"owner": row["lease_owner"]} if row["lease_owner"] else None)
+    if row:
+        approvals_changed(row["machine_id"])
     return {"ok": True}
 
 
+@app.get("/outbox")
+def outbox_list():
+    """Recent outgoing messages, optionally filtered by ?status=queued|sending|sent|dead."""
+    limit = min(request.args.get("limit", 50, type=int), 500)
+    return jsonify({"depth": outbox.depth(), "messages": outbox.recent(request.args.get("status"), limit)})
+
+
+@app.get("/outbox/<message_id>")
+def outbox_status(message_id):
+    message = outbox.get(message_id)
+    if message is None:
+        return {"error": "message not found"}, 404
+    return message
+
+
+@app.post("/outbox/<message_id>/retry")
+def outbox_retry(message_id):
+    """Requeue a dead-lettered message."""
+    if not outbox.retry(message_id):
+        return {"error": "message not dead-lettered"}, 409
+    return {"ok": True}
+
+
+@app.get("/whatsapp/stats")
+def whatsapp_stats():
+    """Per-endpoint Graph API call counts, errors, throttles and latency."""
+    return {"endpoints": wa.stats()}
+
+
+def recording_caption(meta):
+    """Short WhatsApp caption from the agent's recording metadata."""
+    caption_parts = []
+    for key in ("invoice_id", "machine_id", "host", "ip", "time"):
+        if key in meta:
+            caption_parts.append(f"{key}: {meta[key]}")
+    return " | ".join(caption_parts) or "Recording"
+
+
+def accept_recording(con, save_path, sha256, size, meta):
+    """Catalogue a received recording and queue it for WhatsApp delivery.
+
+    Runs inside the caller's transaction (call outbox.wake() after it
+    commits); returns (recording_id, job_id).
+    """
+    recording_id = str(uuid.uuid4())
+    action_id = meta.get("action_id") or None
+    invoice_id, biller_id, machine_id = meta.get("invoice_id"), meta.get("biller_id"), meta.get("machine_id")
+    if action_id and not (invoice_id and biller_id and machine_id):
+        approval = con.execute(
+            "SELECT invoice_id, biller_id, machine_id FROM approvals WHERE id=? "
+            "UNION ALL SELECT invoice_id, biller_id, machine_id FROM approvals_history WHERE id=? LIMIT 1",
+            (action_id, action_id),
+        ).fetchone()
+        if approval:
+            invoice_id = invoice_id or approval["invoice_id"]
+            biller_id = biller_id or approval["biller_id"]
+            machine_id = machine_id or approval["machine_id"]
+    try:
+        duration = float(meta["duration"]) if meta.get("duration") is not None else None
+    except (TypeError, ValueError):
+        duration = None
+
+    now = int(time.time())
+    payload = {"path": os.path.abspath(save_path), "sha256": sha256, "caption": recording_caption(meta),
+               "recording_id": recording_id}
+    job_id = outbox.enqueue("recording", payload, con=con)
+    con.execute(
+        "INSERT INTO recordings (id, action_id, invoice_id, biller_id, machine_id, sha256, path, size, duration, "
+        "host, ip, mac, recorded_at, meta, job_id, created_at, last_accessed_at) "
+        "VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+        (recording_id, action_id, invoice_id or None, biller_id or None, machine_id or None, sha256,
+         os.path.abspath(save_path), size, duration, meta.get("host"), meta.get("ip"), meta.get("mac"),
+         meta.get("time"), json.dumps(meta), job_id, now, now),
+    )
+    if action_id and machine_id:
+        record_event(con, action_id, machine_id, "recorded", {"recording_id": recording_id, "job_id": job_id})
+    return recording_id, job_id
+
+
 @app.post("/upload/recording")
 def upload_recording():
     # Agent sends: multipart form with 'file' (mp4) and 'meta' (json string)
@@ -282,73 +1061,429 @@ def upload_recording():
     f = request.files["file"]
     meta_raw = request.form.get("meta", "{}")
 
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
-    save_path = os.path.join(UPLOAD_DIR, f.filename)
-    f.save(save_path)
+    # The file part was written to disk while the request was parsed; storing
+    # it is a rename, or nothing at all if the same content is already stored
+    incoming = f.stream
+    sha256 = incoming.sha256
+    if blobs.exists(sha256):
+        incoming.close()
+        save_path = blobs.path_for(sha256)
+    else:
+        save_path = blobs.path_for(sha256, create=True)
+        incoming.keep(save_path)
+    upload_bytes.inc(amount=incoming.size)
+    logger.info(f"Received recording {f.filename}: {incoming.size} bytes, sha256 {sha256}")
 
-    # Prepare caption from meta (shortened)
     try:
         meta = json.loads(meta_raw)
     except Exception:
         meta = {"meta": meta_raw}
 
-    caption_parts = []
-    for key in ("invoice_id", "machine_id", "host", "ip", "time"):
-        if key in meta:
-            caption_parts.append(f"{key}: {meta[key]}")
-    caption = " | ".join(caption_parts) or "Recording"
+    if not isinstance(meta, dict):
+        meta = {"meta": meta}
+
+    with db.transaction() as con:
+        recording_id, job_id = accept_recording(con, save_path, sha256, incoming.size, meta)
+    outbox.wake()
+    return ({"ok": True, "job_id": job_id, "recording_id": recording_id, "sha256": sha256}, 202,
+            {"Location": f"/jobs/{job_id}"})
+
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    """Delivery state of a recording accepted by the upload endpoints."""
+    job = outbox.get(job_id)
+    if job is None or job["kind"] != "recording":
+        return {"error": "job not found"}, 404
+    return job
+
+
+# -----------------------------
+# Resumable uploads
+# -----------------------------
+@app.post("/upload/sessions")
+def create_upload_session():
+    """Start a chunked upload: {filename, size, sha256?, meta?}."""
+    data = request.get_json(force=True, silent=True) or {}
+    meta = data.get("meta") or {}
+    if not isinstance(meta, dict):
+        meta = {"meta": meta}
+    session = uploads.create(data.get("filename"), data.get("size"), data.get("sha256"), meta, exists=blobs.exists)
+    return jsonify(session), 201, {"Location": f"/upload/sessions/{session['id']}"}
+
 
+@app.get("/upload/sessions/<session_id>")
+def get_upload_session(session_id):
+    """Received and missing byte ranges (HEAD returns just the Upload-Offset header)."""
+    session = uploads.get(session_id)
+    if session is None:
+        return {"error": "not_found"}, 404
+    return jsonify(session), 200, {"Upload-Offset": str(session["offset"])}
+
+
+@app.put("/upload/sessions/<session_id>")
+def put_upload_chunk(session_id):
+    """Store one chunk: Content-Range: bytes start-end/size, X-Chunk-SHA256: hex digest."""
+    written = uploads.write_chunk(
+        session_id,
+        request.headers.get("Content-Range"),
+        request.headers.get("X-Chunk-SHA256"),
+        request.stream,
+    )
+    upload_bytes.inc(amount=written)
+    session = uploads.get(session_id)
+    return jsonify(session), 200, {"Upload-Offset": str(session["offset"])}
+
+
+@app.post("/upload/sessions/<session_id>/finalize")
+def finalize_upload_session(session_id):
+    """Verify the assembled recording and queue it for sending, like /upload/recording."""
+    session = uploads.get(session_id)
+    if session is None:
+        return {"error": "not_found"}, 404
+    session, accepted, repeated = uploads.finalize(
+        session_id, blobs,
+        on_complete=lambda con, path, sha256: accept_recording(con, path, sha256, session["size"], session["meta"]))
+    if repeated:
+        # A retry after a lost response gets the ids the first finalize returned
+        if accepted is None:
+            return {"ok": True, "duplicate": True}
+        recording_id, job_id = accepted
+        return {"ok": True, "duplicate": True, "job_id": job_id, "recording_id": recording_id}
+    outbox.wake()
+    recording_id, job_id = accepted
+    return {"ok": True, "job_id": job_id, "recording_id": recording_id}, 202, {"Location": f"/jobs/{job_id}"}
+
+
+# -----------------------------
+# Recordings catalogue
+# -----------------------------
+def parse_time(value):
+    """Epoch seconds or an ISO-8601 timestamp from a query string, as epoch seconds."""
+    if value is None or value == "":
+        return None
     try:
-        media_id = wa_upload_media(save_path, mime="video/mp4")
-        wa_send_media(media_id, caption)
-        return {"ok": True}
-    except Exception as e:
-        return {"error": "whatsapp_media_failed", "details": str(e)}, 500
+        return int(float(value))
+    except ValueError:
+        pass
+    try:
+        ts = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=datetime.UTC)
+    return int(ts.timestamp())
+
+
+def recording_view(row):
+    return {
+        "id": row["id"],
+        "action_id": row["action_id"],
+        "invoice_id": row["invoice_id"],
+        "biller_id": row["biller_id"],
+        "machine_id": row["machine_id"],
+        "sha256": row["sha256"],
+        "size": row["size"],
+        "duration": row["duration"],
+        "host": row["host"],
+        "ip": row["ip"],
+        "mac": row["mac"],
+        "recorded_at": row["recorded_at"],
+        "job_id": row["job_id"],
+        "created_at": iso(row["created_at"]),
+        "downscaled_at": iso(row["downscaled_at"]) if row["downscaled_at"] else None,
+        "deleted_at": iso(row["deleted_at"]) if row["deleted_at"] else None,
+        "meta": json.loads(row["meta"]) if row["meta"] else {},
+    }
+
+
+@app.get("/recordings")
+def list_recordings():
+    """Find recordings by invoice_id, biller_id, machine_id or action_id within since/until, newest first."""
+    clauses, params = [], []
+    for column in ("invoice_id", "biller_id", "machine_id", "action_id"):
+        value = request.args.get(column)
+        if value:
+            clauses.append(f"{column}=?")
+            params.append(value)
+    since, until = parse_time(request.args.get("since")), parse_time(request.args.get("until"))
+    if since is not None:
+        clauses.append("created_at>=?")
+        params.append(since)
+    if until is not None:
+        clauses.append("created_at<?")
+        params.append(until)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 500)
+
+    where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+    rows = db.query(f"SELECT * FROM recordings {where}ORDER BY created_at DESC LIMIT ?", (*params, limit))
+    return jsonify({"recordings": [recording_view(r) for r in rows]})
+
+
+def offload_headers(path):
+    """Headers that hand a recording's transfer to the front-end server, or None to send it here."""
+    if RECORDING_ACCEL_PREFIX:
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(UPLOAD_DIR))
+        if not relative.startswith(os.pardir):
+            location = f"{RECORDING_ACCEL_PREFIX.rstrip('/')}/{quote(relative.replace(os.sep, '/'))}"
+            return {"X-Accel-Redirect": location}
+    if USE_X_SENDFILE:
+        return {"X-Sendfile": os.path.abspath(path)}
+    return None
+
+
+@app.get("/recordings/<recording_id>")
+def get_recording(recording_id):
+    """Stream a stored recording with Range, ETag and Last-Modified support.
+
+    The file is never read into Python: full responses go out through the
+    WSGI server's file wrapper (sendfile under gunicorn) and ranges are read
+    straight from the open file, unless the front-end server is told to send
+    it (see offload_headers).
+    """
+    row = db.query_one(
+        "SELECT path, sha256, downscaled_at, deleted_at, last_accessed_at FROM recordings WHERE id=?",
+        (recording_id,),
+    )
+    if row is None:
+        return {"error": "recording not found"}, 404
+    if row["deleted_at"] or not os.path.exists(row["path"]):
+        return {"error": "recording file no longer stored"}, 410
+    # Playback keeps a recording warm for LRU retention; at most one write an
+    # hour so a seeking player doesn't turn every Range request into a write
+    now = int(time.time())
+    if (row["last_accessed_at"] or 0) < now - 3600:
+        db.execute("UPDATE recordings SET last_accessed_at=? WHERE id=?", (now, recording_id))
+    # Content-addressed, so the hash is a strong ETag (distinct once downscaled)
+    etag = f"{row['sha256']}-low" if row["downscaled_at"] else row["sha256"]
+    offload = offload_headers(row["path"])
+    if offload:
+        # Validators are checked here; the front-end server answers Range itself
+        response = Response(status=200, mimetype="video/mp4", headers=offload)
+        response.set_etag(etag)
+        response.last_modified = int(os.path.getmtime(row["path"]))
+        response.cache_control.max_age = RECORDING_CACHE_MAX_AGE
+        response.headers["Content-Disposition"] = f"inline; filename={recording_id}.mp4"
+        response.make_conditional(request)
+    else:
+        response = send_file(
+            row["path"],
+            mimetype="video/mp4",
+            conditional=True,
+            etag=etag,
+            max_age=RECORDING_CACHE_MAX_AGE,
+            download_name=f"{recording_id}.mp4",
+        )
+    # Browser cache only; shared proxies shouldn't keep audit footage
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
 
 
 @app.route("/agent/arm-status/<machine_id>", methods=["GET"])
 def agent_arm_status(machine_id):
-    """Check if agent is armed for the given machine."""
+    """Check if agent is armed for the given machine (304 if If-None-Match is current)."""
     try:
-        # Check if there's an active approval for this machine
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Look for pending approvals for this machine
-        cursor.execute("""
-            SELECT id, status, created_at, consumed
-            FROM approvals 
-            WHERE machine_id = ? AND status = 'allowed' AND consumed = 0
-            ORDER BY created_at DESC 
-            LIMIT 1
-        """, (machine_id,))
-        
-        result = cursor.fetchone()
-        conn.close()
+        # Newest allowed, unconsumed approval for this machine (from the arm cache)
+        state = arm_state(machine_id)
+        etag = {"ETag": f'"{state["version"]}"'}
+        if request.if_none_match.contains(state["version"]):
+            return "", 304, etag
+        result = state["armed"]
         
         if result:
             return {
                 "armed": True,
-                "action_id": result[0],
-                "created_at": result[2],
+                "action_id": result["id"],
+                "created_at": iso(result["created_at"]),
                 "machine_id": machine_id
-            }
+            }, 200, etag
         else:
             return {
                 "armed": False,
                 "machine_id": machine_id
-            }
+            }, 200, etag
             
     except Exception as e:
         return {"error": "arm_status_failed", "details": str(e)}, 500
 
 
+# Approval events -> what the agent should do about them
+# ("released" hands a claimed task back, so other agents may claim it)
+STREAM_EVENTS = {"allowed": "arm", "released": "arm", "denied": "disarm", "consumed": "disarm", "expired": "expire"}
+
+
+def sse(event, data, event_id=None):
+    """Format one server-sent event."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get("/agent/stream/<machine_id>")
+def agent_stream(machine_id):
+    """Push arm/disarm/expire events for one machine as server-sent events.
+
+    Reconnecting clients send Last-Event-ID and get every event after it
+    replayed from approval_events, so nothing is missed across drops. A fresh
+    connection instead gets the current arm state as its first event. A lease
+    that lapses writes no event, so the stream also announces tasks whose
+    lease has run out (again after a reconnect) for another agent to claim.
+    """
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    try:
+        cursor = int(last_event_id) if last_event_id else None
+    except ValueError:
+        cursor = None
+
+    def lapsed_leases():
+        return db.query(
+            "SELECT id, invoice_id, biller_id, admin_url, lease_expires_at FROM approvals "
+            "WHERE machine_id=? AND status=? AND consumed=0 AND lease_expires_at<=? ORDER BY id DESC",
+            (machine_id, STATUS_ALLOWED, int(time.time())),
+        )
+
+    def generate():
+        nonlocal cursor
+        yield "retry: 2000\n\n"
+        # (action id, lease expiry) of lapsed leases already announced
+        announced = set()
+        if cursor is None:
+            row = db.query_one("SELECT MAX(id) FROM approval_events WHERE machine_id=?", (machine_id,))
+            cursor = row[0] or 0
+            # The current arm state below already covers these
+            announced = {(r["id"], r["lease_expires_at"]) for r in lapsed_leases()}
+            current = armed_tasks(machine_id)
+            if current:
+                yield sse("arm", current[0], cursor)
+
+        started = last_sent = time.monotonic()
+        since = None
+        while True:
+            version = notifier.version(machine_id)
+            # Only a notification (a change in this process, or one that
+            # change_watcher saw) sends an idle stream back to the database
+            if version != since:
+                since = version
+                rows = db.query(
+                    "SELECT e.id, e.event, e.action_id, a.invoice_id, a.biller_id, a.admin_url, a.status, a.consumed, "
+                    "a.lease_expires_at "
+                    "FROM approval_events e LEFT JOIN approvals a ON a.id = e.action_id "
+                    "WHERE e.machine_id=? AND e.id>? ORDER BY e.id LIMIT 100",
+                    (machine_id, cursor),
+                )
+                for r in rows:
+                    cursor = r["id"]
+                    kind = STREAM_EVENTS.get(r["event"])
+                    if kind is None:
+                        continue
+                    data = {"id": r["action_id"]}
+                    if kind == "arm":
+                        # Replayed approvals that were consumed, revoked or claimed since are skipped
+                        if r["status"] != STATUS_ALLOWED or r["consumed"] or (r["lease_expires_at"] or 0) > time.time():
+                            continue
+                        data.update(invoice_id=r["invoice_id"], biller_id=r["biller_id"],
+                                    admin_url=r["admin_url"], status="allowed")
+                    yield sse(kind, data, cursor)
+                    last_sent = time.monotonic()
+                if len(rows) == 100:
+                    since = None  # more to replay
+                    continue
+
+                for r in lapsed_leases():
+                    if (r["id"], r["lease_expires_at"]) in announced:
+                        continue
+                    announced.add((r["id"], r["lease_expires_at"]))
+                    yield sse("arm", {"id": r["id"], "invoice_id": r["invoice_id"], "biller_id": r["biller_id"],
+                                      "admin_url": r["admin_url"], "status": "allowed"}, cursor)
+                    last_sent = time.monotonic()
+
+            now = time.monotonic()
+            if STREAM_MAX_SECONDS and now - started >= STREAM_MAX_SECONDS:
+                return
+            if now - last_sent >= STREAM_HEARTBEAT_SECONDS:
+                yield ": keepalive\n\n"
+                last_sent = now
+            # Other processes' changes and lapsed leases arrive through change_watcher
+            notifier.wait(machine_id, since, STREAM_HEARTBEAT_SECONDS)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# -----------------------------
+# Change feed
+# -----------------------------
+# approval_events is append-only and written in the same transaction as the
+# change it describes; SQLite commits one writer at a time, so ids become
+# visible in order and a consumer never skips a row behind its cursor
+EVENTS_MAX_LIMIT = 1000
+
+
+def event_view(row):
+    return {
+        "id": row["id"],
+        "action_id": row["action_id"],
+        "machine_id": row["machine_id"],
+        "event": row["event"],
+        "at": iso(row["created_at"]),
+        "data": json.loads(row["data"]) if row["data"] else {},
+    }
+
+
+@app.get("/events")
+def events_feed():
+    """Approval changes after a cursor: ?since=<event id>&limit=N[&machine_id=].
+
+    Keyset-paginated on the event id. Start with since=0 (or omitted), then
+    pass back `next_cursor`; `has_more` says whether to fetch again straight
+    away.
+    """
+    since = max(request.args.get("since", 0, type=int), 0)
+    limit = min(max(request.args.get("limit", 100, type=int), 1), EVENTS_MAX_LIMIT)
+    machine_id = request.args.get("machine_id")
+    if machine_id:
+        rows = db.query(
+            "SELECT * FROM approval_events WHERE machine_id=? AND id>? ORDER BY id LIMIT ?",
+            (machine_id, since, limit + 1),
+        )
+    else:
+        rows = db.query("SELECT * FROM approval_events WHERE id>? ORDER BY id LIMIT ?", (since, limit + 1))
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify({
+        "events": [event_view(r) for r in rows],
+        "next_cursor": rows[-1]["id"] if rows else since,
+        "has_more": has_more,
+    })
+
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
     return {"error": "endpoint not found"}, 404
 
 
+@app.errorhandler(UploadError)
+def upload_error(e):
+    body = {"error": e.error}
+    if e.details:
+        body["details"] = e.details
+    return jsonify(body), e.status
+
+
+@app.errorhandler(PoolExhausted)
+def pool_exhausted(e):
+    logger.warning(f"Database busy: {e}")
+    return {"error": "database_busy", "details": str(e)}, 503, {"Retry-After": "1"}
+
+
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {error}")
@@ -0,0 +1,98 @@
+"""
+In-process cache of each machine's arm state.
+
+Agents poll /tasks/<machine_id> and /agent/arm-status/<machine_id> far more
+often than the answer changes: it only changes when an approval for that
+machine is allowed, claimed, released, consumed or expired. Each worker keeps
+the last answer per machine in memory. The code paths that make those changes
+drop the machine's entry right after committing (write-through invalidation)
+and the next read reloads it from SQLite.
+
+A change committed by another worker process never reaches this process's
+writers, so each cache also follows approval_events, where every such change
+appends a row: at most every `sync_interval` seconds it reads the events past
+the last one it saw and drops the machines they name. A task hidden by a lease
+comes back when the lease lapses, without any write, so an entry also expires
+at the time its loader says it stops being valid.
+"""
+import time
+import threading
+
+
+class ArmCache:
+    """Per-machine values from `loader`, invalidated by writers and by approval_events."""
+
+    def __init__(self, db, loader, sync_interval=1.0, max_entries=10000):
+        # loader(machine_id) -> (value, valid_until epoch seconds or None)
+        self.db = db
+        self.loader = loader
+        self.sync_interval = sync_interval
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generation = 0
+        self._last_event_id = None
+        self._synced_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        # Optional hook: observer(hit) on every lookup
+        self.observer = None
+
+    def get(self, machine_id):
+        self._sync()
+        entry = self._entries.get(machine_id)
+        if entry is not None and (entry[1] is None or entry[1] > time.time()):
+            self.hits += 1
+            if self.observer:
+                self.observer(True)
+            return entry[0]
+
+        self.misses += 1
+        if self.observer:
+            self.observer(False)
+        generation = self._generation
+        value, valid_until = self.loader(machine_id)
+        with self._lock:
+            # An invalidation while we were loading may mean our value is
+            # already stale; serve it, but don't cache it
+            if generation == self._generation:
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+                self._entries[machine_id] = (value, valid_until)
+        return value
+
+    def invalidate(self, machine_id):
+        """Drop a machine's entry; call after committing a change to its approvals."""
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(machine_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _sync(self):
+        """Drop machines that changed in other processes since the last sync."""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._synced_at < self.sync_interval:
+                return
+            self._synced_at = now
+
+        if self._last_event_id is None:
+            # Nothing is cached yet, so only the starting point matters
+            self._last_event_id = self.db.query_one("SELECT MAX(id) FROM approval_events")[0] or 0
+            return
+        while True:
+            rows = self.db.query(
+                "SELECT id, machine_id FROM approval_events WHERE id>? ORDER BY id LIMIT 1000",
+                (self._last_event_id,),
+            )
+            if not rows:
+                return
+            for r in rows:
+                self.invalidate(r["machine_id"])
+            self._last_event_id = rows[-1]["id"]
+            if len(rows) < 1000:
+                return
@@ -0,0 +1,46 @@
+"""
+Content-addressed recording store.
+
+Recordings are kept under their SHA-256 in two levels of sharded directories
+(`ab/cd/abcd...mp4`), so a re-sent or retried recording maps to the file that
+is already there instead of a second copy under another name, and no
+directory grows past a few hundred entries. Files arrive by rename from the
+upload staging directories, which live on the same filesystem.
+"""
+import os
+import re
+
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+class BlobStore:
+    """Files keyed by SHA-256 under `root`."""
+
+    def __init__(self, root, suffix=".mp4"):
+        self.root = root
+        self.suffix = suffix
+
+    def path_for(self, sha256, create=False):
+        sha256 = sha256.lower()
+        if not SHA256_HEX.match(sha256):
+            raise ValueError(f"not a sha256 hex digest: {sha256!r}")
+        directory = os.path.join(self.root, sha256[:2], sha256[2:4])
+        if create:
+            os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, sha256 + self.suffix)
+
+    def exists(self, sha256):
+        try:
+            return os.path.exists(self.path_for(sha256))
+        except ValueError:
+            return False
+
+    def put(self, src_path, sha256):
+        """Move `src_path` into the store (or drop it if the blob exists); returns the blob path."""
+        dest = self.path_for(sha256, create=True)
+        if os.path.exists(dest):
+            if src_path and os.path.exists(src_path):
+                os.remove(src_path)
+        else:
+            os.replace(src_path, dest)
+        return dest
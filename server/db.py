@@ -0,0 +1,185 @@
+"""
+SQLite storage layer for the Zorder backend.
+
+All routes go through a single `Database` instance which keeps a small pool of
+persistent connections per worker process. Each connection is opened once in
+WAL mode with tuned pragmas, so requests skip the connect/close churn and reuse
+the connection's prepared-statement cache.
+"""
+import os
+import time
+import queue
+import sqlite3
+import threading
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Approval status codes (stored as integers since schema v2)
+STATUS_PENDING = 0
+STATUS_ALLOWED = 1
+STATUS_DENIED = 2
+STATUS_EXPIRED = 3  # unanswered or unused past its TTL (schema v10)
+
+STATUS_NAMES = {
+    STATUS_PENDING: "pending",
+    STATUS_ALLOWED: "allowed",
+    STATUS_DENIED: "denied",
+    STATUS_EXPIRED: "expired",
+}
+
+
+class PoolExhausted(sqlite3.OperationalError):
+    """No pooled connection came free within the busy timeout."""
+
+
+class Database:
+    """Pooled SQLite access shared by every route."""
+
+    def __init__(self, path, pool_size=8, busy_timeout_ms=5000, cache_size_kib=20000,
+                 synchronous="NORMAL", cached_statements=256):
+        self.path = path
+        self.pool_size = pool_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kib = cache_size_kib
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._pool = queue.LifoQueue()
+        self._opened = 0
+        self._stats = {"transactions": 0, "lock_wait_seconds": 0.0, "lock_wait_max_seconds": 0.0,
+                       "busy_errors": 0, "pool_waits": 0, "pool_timeouts": 0}
+        # Optional timing hook: observer(op, seconds) with op in query/transaction/lock_wait
+        self.observer = None
+
+    def _connect(self):
+        """Open a new connection and apply the per-connection pragmas."""
+        con = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,            # explicit BEGIN/COMMIT via transaction()
+            check_same_thread=False,         # pooled; only one thread uses it at a time
+            cached_statements=self.cached_statements,
+        )
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(f"PRAGMA synchronous={self.synchronous}")
+        con.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        con.execute(f"PRAGMA cache_size=-{int(self.cache_size_kib)}")
+        con.execute("PRAGMA temp_store=MEMORY")
+        return con
+
+    def _reset_after_fork(self):
+        """Drop connections inherited from a parent process (gunicorn preload etc.)."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pool = queue.LifoQueue()
+            self._opened = 0
+
+    def _acquire(self):
+        if self._pid != os.getpid():
+            self._reset_after_fork()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.pool_size:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+            self._stats["pool_waits"] += 1
+        try:
+            return self._pool.get(timeout=self.busy_timeout_ms / 1000)
+        except queue.Empty:
+            with self._lock:
+                self._stats["pool_timeouts"] += 1
+            raise PoolExhausted(f"connection pool exhausted ({self.pool_size} connections busy)") from None
+
+    def _release(self, con):
+        if con.in_transaction:
+            con.rollback()
+        self._pool.put(con)
+
+    @contextmanager
+    def connection(self):
+        """Check a pooled connection out for the duration of the block."""
+        con = self._acquire()
+        try:
+            yield con
+        finally:
+            self._release(con)
+
+    @contextmanager
+    def transaction(self):
+        """Run the block inside a single write transaction (BEGIN IMMEDIATE)."""
+        with self.connection() as con:
+            # Time spent here is time spent waiting for another writer to commit
+            started = time.perf_counter()
+            try:
+                con.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                with self._lock:
+                    self._stats["busy_errors"] += 1
+                raise
+            waited = time.perf_counter() - started
+            # We hold SQLite's write lock now, so no other writer in this
+            # process can be updating these counters concurrently
+            self._stats["transactions"] += 1
+            self._stats["lock_wait_seconds"] += waited
+            self._stats["lock_wait_max_seconds"] = max(self._stats["lock_wait_max_seconds"], waited)
+            try:
+                yield con
+            except BaseException:
+                con.rollback()
+                raise
+            con.commit()
+            if self.observer:
+                self.observer("lock_wait", waited)
+                self.observer("transaction", time.perf_counter() - started - waited)
+
+    def query(self, sql, params=()):
+        """Return all rows for a read-only statement."""
+        with self.connection() as con:
+            started = time.perf_counter()
+            rows = con.execute(sql, params).fetchall()
+        if self.observer:
+            self.observer("query", time.perf_counter() - started)
+        return rows
+
+    def query_one(self, sql, params=()):
+        """Return the first row for a read-only statement, or None."""
+        with self.connection() as con:
+            started = time.perf_counter()
+            row = con.execute(sql, params).fetchone()
+        if self.observer:
+            self.observer("query", time.perf_counter() - started)
+        return row
+
+    def execute(self, sql, params=()):
+        """Run a single write statement in its own transaction; returns rowcount."""
+        with self.transaction() as con:
+            return con.execute(sql, params).rowcount
+
+    def stats(self):
+        """Write-lock contention counters for this process."""
+        return dict(self._stats)
+
+    def close(self):
+        """Close every idle pooled connection."""
+        while True:
+            try:
+                con = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
+            with self._lock:
+                self._opened -= 1
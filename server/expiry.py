@@ -0,0 +1,137 @@
+"""
+Approval TTLs and archival.
+
+Approvals the owner never answers, and allowed ones no agent ever uses,
+would otherwise sit in `approvals` forever and slow down every /tasks and
+arm-status query. A background sweeper:
+
+1. marks pending approvals older than `pending_ttl` and allowed, unconsumed
+   approvals not used within `allowed_ttl` as expired, appending an
+   `expired` event (which the agent stream turns into `expire`);
+2. moves finished approvals (consumed, denied or expired) that haven't
+   changed for `archive_after` seconds to `approvals_history`, appending an
+   `archived` event;
+3. deletes `approval_events` rows older than `events_ttl`.
+
+All steps work in bounded batches, each in its own short transaction, so the
+hot table stays small without ever holding the write lock for long.
+"""
+import os
+import time
+import logging
+import threading
+
+from db import STATUS_PENDING, STATUS_ALLOWED, STATUS_DENIED, STATUS_EXPIRED
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = "id, invoice_id, biller_id, machine_id, admin_url, status, created_at, consumed, updated_at"
+
+
+class ApprovalSweeper:
+    """Expires stale approvals and archives finished ones, in batches."""
+
+    def __init__(self, db, record_event, pending_ttl=86400, allowed_ttl=86400, archive_after=7 * 86400,
+                 events_ttl=90 * 86400, batch_size=500, interval=60, pause=0.1):
+        self.db = db
+        self.record_event = record_event
+        self.pending_ttl = pending_ttl
+        self.allowed_ttl = allowed_ttl
+        self.archive_after = archive_after
+        self.events_ttl = events_ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._pid = None
+        # Optional hook: on_expired(machine_ids) after each committed batch
+        self.on_expired = None
+
+    def _expire_batch(self, status, cutoff):
+        now = int(time.time())
+        with self.db.transaction() as con:
+            # A task an agent still holds a live lease on is in use, not stale
+            rows = con.execute(
+                "SELECT id, machine_id FROM approvals WHERE status=? AND consumed=0 AND updated_at<? "
+                "AND (lease_expires_at IS NULL OR lease_expires_at<=?) LIMIT ?",
+                (status, cutoff, now, self.batch_size),
+            ).fetchall()
+            for r in rows:
+                con.execute("UPDATE approvals SET status=?, updated_at=? WHERE id=?", (STATUS_EXPIRED, now, r["id"]))
+                self.record_event(con, r["id"], r["machine_id"], "expired")
+        if rows and self.on_expired:
+            self.on_expired({r["machine_id"] for r in rows})
+        return len(rows)
+
+    def _archive_batch(self, status, consumed, cutoff):
+        now = int(time.time())
+        with self.db.transaction() as con:
+            rows = con.execute(
+                "SELECT id, machine_id FROM approvals WHERE status=? AND consumed=? AND updated_at<? LIMIT ?",
+                (status, consumed, cutoff, self.batch_size),
+            ).fetchall()
+            ids = [r["id"] for r in rows]
+            if ids:
+                marks = ",".join("?" * len(ids))
+                con.execute(
+                    f"INSERT OR REPLACE INTO approvals_history ({COLUMNS}, archived_at) "
+                    f"SELECT {COLUMNS}, ? FROM approvals WHERE id IN ({marks})",
+                    (now, *ids),
+                )
+                con.execute(f"DELETE FROM approvals WHERE id IN ({marks})", ids)
+                for r in rows:
+                    self.record_event(con, r["id"], r["machine_id"], "archived")
+        return len(ids)
+
+    def _prune_events_batch(self, cutoff):
+        # Ids grow with time (AUTOINCREMENT, never reused), so the oldest rows
+        # come first in rowid order and the scan stops after one batch
+        return self.db.execute(
+            "DELETE FROM approval_events WHERE id IN "
+            "(SELECT id FROM approval_events WHERE created_at<? ORDER BY id LIMIT ?)",
+            (cutoff, self.batch_size),
+        )
+
+    def _drain(self, step, *args):
+        total = 0
+        while True:
+            n = step(*args)
+            total += n
+            if n < self.batch_size:
+                return total
+            time.sleep(self.pause)
+
+    def sweep(self):
+        """One pass; returns (expired, archived, pruned) row counts."""
+        now = int(time.time())
+        expired = archived = pruned = 0
+        if self.pending_ttl:
+            expired += self._drain(self._expire_batch, STATUS_PENDING, now - self.pending_ttl)
+        if self.allowed_ttl:
+            expired += self._drain(self._expire_batch, STATUS_ALLOWED, now - self.allowed_ttl)
+        if self.archive_after:
+            cutoff = now - self.archive_after
+            finished = [(s, 1) for s in (STATUS_PENDING, STATUS_ALLOWED, STATUS_DENIED, STATUS_EXPIRED)]
+            finished += [(STATUS_DENIED, 0), (STATUS_EXPIRED, 0)]
+            for status, consumed in finished:
+                archived += self._drain(self._archive_batch, status, consumed, cutoff)
+        if self.events_ttl:
+            pruned = self._drain(self._prune_events_batch, now - self.events_ttl)
+        if expired or archived or pruned:
+            logger.info(f"Approval sweep: {expired} expired, {archived} archived, {pruned} events pruned")
+        return expired, archived, pruned
+
+    def start(self):
+        """Sweep every `interval` seconds in a daemon thread (restarted after fork)."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+
+        def run():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Approval sweep failed: {e}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=run, name="approval-sweeper", daemon=True).start()
@@ -0,0 +1,288 @@
+"""
+Prometheus-style metrics without external dependencies.
+
+Counters and histograms are sharded per thread: the hot path only touches the
+calling thread's own dict. A thread takes a lock once, to register its shard
+on its first sample; after that, recording takes no lock. Shards are merged
+when /metrics is scraped. Shards of finished threads are folded into a
+retired total so request-per-thread servers don't leak; the fold runs each
+time the shard list doubles, so its cost is spread over many new threads.
+
+Multi-process deployments set a shared `metrics_dir`: every process
+periodically writes its merged snapshot there, and a scrape of any worker
+sums the snapshots of all of them. The snapshot of a process that no longer
+exists (a recycled worker, an earlier server run) is folded into
+`metrics-retired.json` and then deleted, so totals never go backwards. Gauges are
+computed at scrape time by registered callbacks (e.g. queue depth straight
+from the database), so they are already process-independent.
+"""
+import os
+import json
+import glob
+import time
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by someone else
+    return True
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []       # (thread, dict) per recording thread
+        self._retired = {}      # merged values of threads that have exited
+        self._fold_at = 64      # shard count at which dead threads are folded next
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:  # once per thread, not per sample
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) >= self._fold_at:
+                    self._fold_dead()
+                    self._fold_at = max(64, 2 * len(self._shards))
+        return shard
+
+    def _fold_dead(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge_into(self._retired, shard)
+        self._shards = alive
+
+    def snapshot(self):
+        """Merged values across all threads: {label_values: value}."""
+        with self._lock:
+            self._fold_dead()
+            merged = {}
+            self._merge_into(merged, self._retired)
+            for _, shard in self._shards:
+                self._merge_into(merged, dict(shard))
+            return merged
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    @staticmethod
+    def _merge_into(target, source):
+        for key, value in source.items():
+            target[key] = target.get(key, 0) + value
+
+    def render(self, merged):
+        for key, value in sorted(merged.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        shard = self._shard()
+        entry = shard.get(labelvalues)
+        if entry is None:
+            # per-bucket (non-cumulative) counts, then sum and count
+            entry = shard[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[i] += 1
+                break
+        entry[-2] += value
+        entry[-1] += 1
+
+    @staticmethod
+    def _merge_into(target, source):
+        for key, entry in source.items():
+            current = target.get(key)
+            if current is None:
+                target[key] = list(entry)
+            else:
+                for i, v in enumerate(entry):
+                    current[i] += v
+
+    def render(self, merged):
+        for key, entry in sorted(merged.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, entry):
+                cumulative += n
+                le = 'le="%s"' % bound
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_labels(self.labelnames, key, le)} {entry[-1]}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {entry[-2]}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {entry[-1]}"
+
+
+class Registry:
+    """Holds every metric and renders the Prometheus text format."""
+
+    def __init__(self, metrics_dir=None, flush_interval=5.0):
+        self.metrics_dir = metrics_dir
+        self.flush_interval = flush_interval
+        self._metrics = []
+        self._gauges = []   # (name, help, labelnames, callback)
+        self._flusher_pid = None
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help_text, labelnames, callback):
+        """Register a gauge whose samples `callback()` returns as {label_values: value} at scrape time."""
+        self._gauges.append((name, help_text, tuple(labelnames), callback))
+
+    # -----------------------------
+    # Multi-process snapshots
+    # -----------------------------
+    def _local_snapshot(self):
+        return {m.name: [[list(k), v] for k, v in m.snapshot().items()] for m in self._metrics}
+
+    def flush(self):
+        """Write this process's snapshot to metrics_dir (atomically)."""
+        if not self.metrics_dir:
+            return
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f"metrics-{os.getpid()}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as fh:
+            json.dump(self._local_snapshot(), fh)
+        os.replace(tmp, path)
+
+    def start_flusher(self):
+        """Flush periodically from a background thread (restarted after fork)."""
+        if not self.metrics_dir or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except OSError as e:
+                    logger.warning(f"Metrics flush failed: {e}")
+
+        threading.Thread(target=run, name="metrics-flush", daemon=True).start()
+
+    def _read(self, path):
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _merge_snapshot(self, merged, data):
+        """Add a snapshot as written by flush() into `merged` ({name: {label_values: value}})."""
+        for metric in self._metrics:
+            if metric.name in data:
+                metric._merge_into(merged.setdefault(metric.name, {}),
+                                   {tuple(k): v for k, v in data[metric.name]})
+
+    def _merged(self):
+        if not self.metrics_dir:
+            return {m.name: m.snapshot() for m in self._metrics}
+        self.flush()
+        retired_path = os.path.join(self.metrics_dir, "metrics-retired.json")
+        # Scrapes of different workers take turns, so a dead process's
+        # snapshot is folded into the retired totals exactly once and no
+        # scrape sees it in neither place
+        with open(os.path.join(self.metrics_dir, "metrics.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            live, dead = [], []
+            for path in glob.glob(os.path.join(self.metrics_dir, "metrics-*.json")):
+                try:
+                    pid = int(os.path.basename(path)[len("metrics-"):-len(".json")])
+                except ValueError:
+                    continue  # metrics-retired.json
+                (live if pid == os.getpid() or _pid_alive(pid) else dead).append(path)
+
+            retired = {}
+            self._merge_snapshot(retired, self._read(retired_path))
+            if dead:
+                for path in dead:
+                    self._merge_snapshot(retired, self._read(path))
+                tmp = f"{retired_path}.{os.getpid()}.tmp"
+                with open(tmp, "w") as fh:
+                    json.dump({name: [[list(k), v] for k, v in samples.items()] for name, samples in retired.items()}, fh)
+                os.replace(tmp, retired_path)
+                for path in dead:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+            merged = {m.name: {} for m in self._metrics}
+            for metric in self._metrics:
+                metric._merge_into(merged[metric.name], retired.get(metric.name, {}))
+            for path in live:
+                self._merge_snapshot(merged, self._read(path))
+        return merged
+
+    # -----------------------------
+    # Exposition
+    # -----------------------------
+    def render(self):
+        lines = []
+        merged = self._merged()
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(merged[metric.name]))
+        for name, help_text, labelnames, callback in self._gauges:
+            try:
+                samples = callback()
+            except Exception as e:
+                logger.warning(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for key, value in sorted(samples.items()):
+                lines.append(f"{name}{_labels(labelnames, key)} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,296 @@
+"""
+Forward-only schema migrations for the Zorder backend database.
+
+`run_migrations()` is called once at startup. Each migration runs in its own
+write transaction together with the `schema_version` row that records it, so a
+crash mid-way leaves the database at the previous version and the migration is
+simply retried on the next start. Never edit a migration that has shipped;
+append a new one instead.
+"""
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def _v1_initial(con):
+    """Original schema: text status and ISO text timestamps, no indexes."""
+    con.execute(
+        """
+        CREATE TABLE IF NOT EXISTS approvals (
+            id TEXT PRIMARY KEY,
+            invoice_id TEXT,
+            biller_id TEXT,
+            machine_id TEXT,
+            admin_url TEXT,
+            status TEXT,
+            created_at TEXT,
+            consumed INTEGER DEFAULT 0
+        )
+        """
+    )
+
+
+def _v2_integer_status_and_index(con):
+    """Integer status codes, epoch timestamps and a covering index for agent polls."""
+    con.execute(
+        """
+        CREATE TABLE approvals_v2 (
+            id TEXT PRIMARY KEY,
+            invoice_id TEXT,
+            biller_id TEXT,
+            machine_id TEXT,
+            admin_url TEXT,
+            status INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            consumed INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    # Convert rows in place: 'pending'/'allowed'/'denied' -> 0/1/2, ISO text -> epoch seconds
+    con.execute(
+        """
+        INSERT INTO approvals_v2 (id, invoice_id, biller_id, machine_id, admin_url, status, created_at, consumed)
+        SELECT id, invoice_id, biller_id, machine_id, admin_url,
+               CASE status WHEN 'allowed' THEN 1 WHEN 'denied' THEN 2 ELSE 0 END,
+               COALESCE(CAST(strftime('%s', substr(created_at, 1, 19)) AS INTEGER),
+                        CAST(strftime('%s', 'now') AS INTEGER)),
+               COALESCE(consumed, 0)
+        FROM approvals
+        """
+    )
+    con.execute("DROP TABLE approvals")
+    con.execute("ALTER TABLE approvals_v2 RENAME TO approvals")
+    # Serves /tasks and /agent/arm-status straight from the index (id rides along
+    # so arm-status never touches the table)
+    con.execute(
+        "CREATE INDEX idx_approvals_machine_armed "
+        "ON approvals (machine_id, status, consumed, created_at, id)"
+    )
+
+
+def _v3_approval_events(con):
+    """Append-only log of approval state changes, read by /agent/stream."""
+    con.execute(
+        """
+        CREATE TABLE approval_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            action_id TEXT NOT NULL,
+            machine_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_approval_events_machine ON approval_events (machine_id, id)")
+
+
+def _v4_outbox(con):
+    """Persistent queue of outgoing WhatsApp messages (see outbox.py)."""
+    con.execute(
+        """
+        CREATE TABLE outbox (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL,
+            last_error TEXT,
+            result TEXT,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_outbox_due ON outbox (status, next_attempt_at)")
+
+
+def _v5_webhook_messages(con):
+    """WhatsApp message ids already applied by the webhook (idempotency store)."""
+    con.execute(
+        "CREATE TABLE webhook_messages (message_id TEXT PRIMARY KEY, received_at INTEGER NOT NULL)"
+    )
+    con.execute("CREATE INDEX idx_webhook_messages_received ON webhook_messages (received_at)")
+
+
+def _v6_upload_sessions(con):
+    """Resumable chunked recording uploads: declared size, checksum and received byte ranges."""
+    con.execute(
+        """
+        CREATE TABLE upload_sessions (
+            id TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            sha256 TEXT,
+            meta TEXT,
+            received TEXT NOT NULL DEFAULT '[]',
+            received_bytes INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_upload_sessions_updated ON upload_sessions (updated_at)")
+
+
+def _v7_media_cache(con):
+    """WhatsApp media ids of uploaded recordings, keyed by content hash, until they expire."""
+    con.execute(
+        """
+        CREATE TABLE media_cache (
+            sha256 TEXT PRIMARY KEY,
+            media_id TEXT NOT NULL,
+            expires_at INTEGER NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_media_cache_expires ON media_cache (expires_at)")
+
+
+def _v8_recordings(con):
+    """Catalogue of received recordings and the agent metadata sent with them.
+
+    action_id refers to approvals.id; there is no foreign key because
+    recordings outlive approval rows and may arrive for unknown actions.
+    """
+    con.execute(
+        """
+        CREATE TABLE recordings (
+            id TEXT PRIMARY KEY,
+            action_id TEXT,
+            invoice_id TEXT,
+            biller_id TEXT,
+            machine_id TEXT,
+            sha256 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            duration REAL,
+            host TEXT,
+            ip TEXT,
+            mac TEXT,
+            recorded_at TEXT,
+            meta TEXT,
+            job_id TEXT,
+            created_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_recordings_invoice ON recordings (invoice_id, created_at)")
+    con.execute("CREATE INDEX idx_recordings_biller ON recordings (biller_id, created_at)")
+    con.execute("CREATE INDEX idx_recordings_machine ON recordings (machine_id, created_at)")
+    con.execute("CREATE INDEX idx_recordings_action ON recordings (action_id)")
+    con.execute("CREATE INDEX idx_recordings_created ON recordings (created_at)")
+
+
+def _v9_recording_retention(con):
+    """Retention bookkeeping: last playback (for LRU), downscaled and deleted markers."""
+    con.execute("ALTER TABLE recordings ADD COLUMN last_accessed_at INTEGER")
+    con.execute("ALTER TABLE recordings ADD COLUMN downscaled_at INTEGER")
+    con.execute("ALTER TABLE recordings ADD COLUMN deleted_at INTEGER")
+    con.execute("UPDATE recordings SET last_accessed_at = created_at")
+    con.execute("CREATE INDEX idx_recordings_sha256 ON recordings (sha256)")
+    con.execute("CREATE INDEX idx_recordings_last_accessed ON recordings (last_accessed_at)")
+
+
+def _v10_approval_expiry(con):
+    """Last state change per approval (for TTLs) and a history table for finished approvals."""
+    con.execute("ALTER TABLE approvals ADD COLUMN updated_at INTEGER")
+    con.execute("UPDATE approvals SET updated_at = created_at")
+    con.execute("CREATE INDEX idx_approvals_status_updated ON approvals (status, consumed, updated_at)")
+    con.execute(
+        """
+        CREATE TABLE approvals_history (
+            id TEXT PRIMARY KEY,
+            invoice_id TEXT,
+            biller_id TEXT,
+            machine_id TEXT,
+            admin_url TEXT,
+            status INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            consumed INTEGER NOT NULL,
+            updated_at INTEGER,
+            archived_at INTEGER NOT NULL
+        )
+        """
+    )
+    con.execute("CREATE INDEX idx_approvals_history_invoice ON approvals_history (invoice_id)")
+    con.execute("CREATE INDEX idx_approvals_history_machine ON approvals_history (machine_id, created_at)")
+
+
+def _v11_task_leases(con):
+    """Lease on an allowed approval, so only one agent per machine works on it at a time."""
+    con.execute("ALTER TABLE approvals ADD COLUMN lease_token TEXT")
+    con.execute("ALTER TABLE approvals ADD COLUMN lease_owner TEXT")
+    con.execute("ALTER TABLE approvals ADD COLUMN lease_expires_at INTEGER")
+
+
+def _v12_approval_event_data(con):
+    """Optional JSON details per approval event (row values on create, lease owner, who answered)."""
+    con.execute("ALTER TABLE approval_events ADD COLUMN data TEXT")
+
+
+def _v13_upload_session_result(con):
+    """What finalizing an upload session produced, returned again on a repeated finalize."""
+    con.execute("ALTER TABLE upload_sessions ADD COLUMN result TEXT")
+
+
+def _v14_approval_approver(con):
+    """The WhatsApp number an approval's prompt went to (NULL = OWNER_WA_NUMBER); only it may answer."""
+    con.execute("ALTER TABLE approvals ADD COLUMN approver TEXT")
+
+
+def _v15_recording_downscale_failed(con):
+    """When ffmpeg last failed to downscale a recording (downscaled_at is only set on success)."""
+    con.execute("ALTER TABLE recordings ADD COLUMN downscale_failed_at INTEGER")
+
+
+MIGRATIONS = [
+    (1, "initial", _v1_initial),
+    (2, "integer_status_and_index", _v2_integer_status_and_index),
+    (3, "approval_events", _v3_approval_events),
+    (4, "outbox", _v4_outbox),
+    (5, "webhook_messages", _v5_webhook_messages),
+    (6, "upload_sessions", _v6_upload_sessions),
+    (7, "media_cache", _v7_media_cache),
+    (8, "recordings", _v8_recordings),
+    (9, "recording_retention", _v9_recording_retention),
+    (10, "approval_expiry", _v10_approval_expiry),
+    (11, "task_leases", _v11_task_leases),
+    (12, "approval_event_data", _v12_approval_event_data),
+    (13, "upload_session_result", _v13_upload_session_result),
+    (14, "approval_approver", _v14_approval_approver),
+    (15, "recording_downscale_failed", _v15_recording_downscale_failed),
+]
+
+
+def current_version(con):
+    row = con.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def run_migrations(db):
+    """Bring the database up to the latest schema version."""
+    with db.transaction() as con:
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, name TEXT, applied_at INTEGER)"
+        )
+
+    for version, name, migrate in MIGRATIONS:
+        # Re-check inside the write lock so concurrently starting workers
+        # don't apply the same migration twice
+        with db.transaction() as con:
+            if current_version(con) >= version:
+                continue
+            logger.info(f"Applying schema migration v{version} ({name})")
+            migrate(con)
+            con.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?,?,?)",
+                (version, name, int(time.time())),
+            )
+
+    with db.connection() as con:
+        return current_version(con)
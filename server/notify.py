@@ -0,0 +1,116 @@
+"""
+In-process change notification for per-machine approval state.
+
+Writers call `notify(machine_id)` after committing a change that affects what
+an agent should see; long-poll requests park in `wait()` until that happens.
+Each machine has its own condition (sharing one lock), so a change only wakes
+the requests waiting on that machine.
+
+Changes committed by other worker processes, and task leases that simply run
+out, never pass through this process's writers. `ChangeWatcher` covers both
+with one background thread per process: every `interval` it reads the new
+approval_events rows and the leases that lapsed since its last pass, and
+notifies the machines they name. Parked requests can then wait on the
+notifier alone instead of each polling the database.
+"""
+import os
+import time
+import logging
+import threading
+
+from db import STATUS_ALLOWED
+
+logger = logging.getLogger(__name__)
+
+
+class MachineNotifier:
+    """Per-machine change counters that parked requests can wait on."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conditions = {}
+        self._versions = {}
+
+    def _condition(self, machine_id):
+        cond = self._conditions.get(machine_id)
+        if cond is None:
+            cond = self._conditions.setdefault(machine_id, threading.Condition(self._lock))
+        return cond
+
+    def version(self, machine_id):
+        """Current change counter for a machine (0 if it never changed)."""
+        return self._versions.get(machine_id, 0)
+
+    def notify(self, machine_id):
+        """Record a change for `machine_id` and wake everyone waiting on it."""
+        cond = self._condition(machine_id)
+        with cond:
+            self._versions[machine_id] = self._versions.get(machine_id, 0) + 1
+            cond.notify_all()
+
+    def wait(self, machine_id, since, timeout):
+        """Block until the machine's version moves past `since` or `timeout` elapses.
+
+        Returns True if a change was observed.
+        """
+        cond = self._condition(machine_id)
+        with cond:
+            return cond.wait_for(lambda: self._versions.get(machine_id, 0) != since, timeout)
+
+
+class ChangeWatcher:
+    """Turns other processes' approval_events and lapsed leases into notifications."""
+
+    def __init__(self, db, notifier, interval=5.0):
+        self.db = db
+        self.notifier = notifier
+        self.interval = interval
+        self._last_event_id = None
+        self._scanned_at = None
+        self._pid = None
+
+    def poll(self):
+        """One pass; returns the machines notified."""
+        now = int(time.time())
+        if self._last_event_id is None:
+            self._last_event_id = self.db.query_one("SELECT MAX(id) FROM approval_events")[0] or 0
+            self._scanned_at = now
+            return set()
+        changed = set()
+        while True:
+            rows = self.db.query(
+                "SELECT id, machine_id FROM approval_events WHERE id>? ORDER BY id LIMIT 1000",
+                (self._last_event_id,),
+            )
+            changed.update(r["machine_id"] for r in rows)
+            if rows:
+                self._last_event_id = rows[-1]["id"]
+            if len(rows) < 1000:
+                break
+        # A lease that runs out writes nothing; each one is seen by exactly one pass
+        changed.update(r[0] for r in self.db.query(
+            "SELECT DISTINCT machine_id FROM approvals WHERE status=? AND consumed=0 "
+            "AND lease_expires_at>? AND lease_expires_at<=?",
+            (STATUS_ALLOWED, self._scanned_at, now),
+        ))
+        self._scanned_at = now
+        for machine_id in changed:
+            self.notifier.notify(machine_id)
+        return changed
+
+    def start(self):
+        """Poll every `interval` seconds in a daemon thread (restarted after fork)."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._last_event_id = None
+
+        def run():
+            while True:
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error(f"Change watch failed: {e}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=run, name="change-watcher", daemon=True).start()
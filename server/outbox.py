@@ -0,0 +1,279 @@
+"""
+Persistent outbox for outgoing WhatsApp messages.
+
+Routes enqueue a message (ideally in the same transaction as the row change
+that caused it) and return immediately; a pool of background worker threads
+claims due messages, delivers them through a registered handler, and retries
+failures with exponential backoff until they are sent or dead-lettered.
+Claims are made under SQLite's write lock, so any number of workers across
+any number of processes can share one queue without claiming a message
+twice. While a message is being delivered its worker keeps renewing the
+claim's lease, so only a crashed worker's message is claimed again; a worker
+whose lease was lost anyway leaves the message's outcome to the new holder.
+Delivery is at least once: a worker that dies after the handler succeeded
+but before recording it has its message sent again.
+
+Slow kinds (recordings: a transcode plus a media upload) can be registered
+into a named pool with its own workers, so a backlog of them never holds up
+short messages such as approval prompts.
+"""
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+SENDING = "sending"
+SENT = "sent"
+DEAD = "dead"
+
+
+class Outbox:
+    """SQLite-backed message queue with a background delivery worker pool."""
+
+    def __init__(self, db, max_attempts=8, backoff_base=2.0, backoff_max=600.0,
+                 lease_seconds=300, poll_interval=1.0):
+        self.db = db
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+
+        self._handlers = {}
+        self._leases = {}
+        self._pools = {}
+        self._wakeup = threading.Event()
+        self._workers = []
+        self._worker_counts = {}
+        self._pid = None
+
+    def register(self, kind, handler, pool=None, lease_seconds=None):
+        """Deliver messages of `kind` with `handler(payload) -> result`.
+
+        The handler may update `payload` in place to checkpoint progress; the
+        updated payload is what the next retry sees. Kinds in a named `pool`
+        are delivered by that pool's workers only (see start()).
+        `lease_seconds` overrides the default lease for slow kinds.
+        """
+        self._handlers[kind] = handler
+        if lease_seconds:
+            self._leases[kind] = lease_seconds
+        if pool:
+            self._pools[kind] = pool
+
+    # -----------------------------
+    # Producers
+    # -----------------------------
+    def enqueue(self, kind, payload, con=None):
+        """Queue a message and return its id.
+
+        Pass `con` to enqueue inside an already open transaction; the caller
+        should then call `wake()` once it has committed.
+        """
+        if con is None:
+            with self.db.transaction() as con:
+                message_id = self._insert(con, kind, payload)
+            self.wake()
+            return message_id
+        return self._insert(con, kind, payload)
+
+    def _insert(self, con, kind, payload):
+        now = int(time.time())
+        message_id = str(uuid.uuid4())
+        con.execute(
+            "INSERT INTO outbox (id, kind, payload, status, attempts, next_attempt_at, created_at, updated_at) "
+            "VALUES (?,?,?,?,0,?,?,?)",
+            (message_id, kind, json.dumps(payload), QUEUED, now, now, now),
+        )
+        return message_id
+
+    def wake(self):
+        """Nudge idle workers to look for due messages now."""
+        self._wakeup.set()
+
+    # -----------------------------
+    # Queries
+    # -----------------------------
+    def get(self, message_id):
+        row = self.db.query_one("SELECT * FROM outbox WHERE id=?", (message_id,))
+        return self._view(row) if row else None
+
+    def recent(self, status=None, limit=50):
+        if status:
+            rows = self.db.query(
+                "SELECT * FROM outbox WHERE status=? ORDER BY created_at DESC LIMIT ?", (status, limit)
+            )
+        else:
+            rows = self.db.query("SELECT * FROM outbox ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [self._view(r) for r in rows]
+
+    def depth(self):
+        """Message counts per status."""
+        rows = self.db.query("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")
+        return {r["status"]: r["n"] for r in rows}
+
+    def retry(self, message_id):
+        """Put a dead-lettered message back on the queue; returns False if it wasn't dead."""
+        now = int(time.time())
+        with self.db.transaction() as con:
+            changed = con.execute(
+                "UPDATE outbox SET status=?, attempts=0, next_attempt_at=?, updated_at=? WHERE id=? AND status=?",
+                (QUEUED, now, now, message_id, DEAD),
+            ).rowcount
+        if changed:
+            self.wake()
+        return bool(changed)
+
+    @staticmethod
+    def _view(row):
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "next_attempt_at": row["next_attempt_at"],
+            "last_error": row["last_error"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    # -----------------------------
+    # Workers
+    # -----------------------------
+    def start(self, workers, pools=None):
+        """Start `workers` delivery threads in this process, plus `pools[name]`
+        threads for each named pool.
+
+        A pool given no workers has its kinds delivered by the general workers.
+        """
+        self._worker_counts = {None: workers, **{name: n for name, n in (pools or {}).items() if n > 0}}
+        self._pid = os.getpid()
+        self._workers = []
+        for pool, count in self._worker_counts.items():
+            for n in range(count):
+                name = f"outbox-{pool}-{n}" if pool else f"outbox-{n}"
+                thread = threading.Thread(target=self._run, args=(pool,), name=name, daemon=True)
+                thread.start()
+                self._workers.append(thread)
+        if self._workers:
+            sizes = ", ".join(f"{n} {p or 'general'}" for p, n in self._worker_counts.items())
+            logger.info(f"Outbox started with {len(self._workers)} workers ({sizes})")
+
+    def ensure_running(self):
+        """Restart the worker threads if this process was forked after start()."""
+        if self._worker_counts and self._pid != os.getpid():
+            pools = dict(self._worker_counts)
+            self.start(pools.pop(None), pools)
+
+    def _kind_filter(self, pool):
+        """SQL condition (and params) on `kind` for the messages `pool` delivers."""
+        if pool:
+            kinds = [k for k, p in self._pools.items() if p == pool]
+            return f"kind IN ({','.join('?' * len(kinds))})", kinds
+        # General workers take everything not owned by a pool that has workers
+        kinds = [k for k, p in self._pools.items() if self._worker_counts.get(p)]
+        if not kinds:
+            return "1", []
+        return f"kind NOT IN ({','.join('?' * len(kinds))})", kinds
+
+    def _claim(self, pool=None):
+        """Atomically take the next due message for `pool`, or return None."""
+        now = int(time.time())
+        kind_sql, kinds = self._kind_filter(pool)
+        due = (f"SELECT * FROM outbox WHERE ((status=? AND next_attempt_at<=?) OR (status=? AND next_attempt_at<=?)) "
+               f"AND {kind_sql} ORDER BY next_attempt_at LIMIT 1")
+        params = (QUEUED, now, SENDING, now, *kinds)
+        # Idle polls only read (WAL readers never block the writer); the write
+        # lock is taken once there is something to claim
+        if self.db.query_one(due, params) is None:
+            return None
+        with self.db.transaction() as con:
+            # Re-checked under the lock: another worker may have claimed it
+            row = con.execute(due, params).fetchone()
+            if row is None:
+                return None
+            # While sending, next_attempt_at doubles as the lease: a worker that
+            # dies mid-delivery leaves the message to be reclaimed after it lapses
+            con.execute(
+                "UPDATE outbox SET status=?, attempts=attempts+1, next_attempt_at=?, updated_at=? WHERE id=?",
+                (SENDING, now + self._leases.get(row["kind"], self.lease_seconds), now, row["id"]),
+            )
+        return row
+
+    def _keep_leased(self, message_id, attempts, lease_seconds, done):
+        """Extend a claim's lease every third of its length until `done` is set."""
+        while not done.wait(lease_seconds / 3):
+            try:
+                held = self.db.execute(
+                    "UPDATE outbox SET next_attempt_at=? WHERE id=? AND status=? AND attempts=?",
+                    (int(time.time()) + lease_seconds, message_id, SENDING, attempts),
+                )
+            except Exception as e:
+                logger.warning(f"Outbox lease renewal failed for {message_id}: {e}")
+                continue
+            if not held:
+                return
+
+    def _finish(self, row, attempts, sql, params):
+        """Record a delivery outcome, unless another worker has claimed the message since."""
+        changed = self.db.execute(f"{sql} WHERE id=? AND status=? AND attempts=?",
+                                  (*params, row["id"], SENDING, attempts))
+        if not changed:
+            logger.warning(f"Outbox message {row['id']} ({row['kind']}) lease lost; outcome left to its new holder")
+
+    def _deliver(self, row):
+        payload = json.loads(row["payload"])
+        attempts = row["attempts"] + 1
+        done = threading.Event()
+        lease_seconds = self._leases.get(row["kind"], self.lease_seconds)
+        threading.Thread(target=self._keep_leased, args=(row["id"], attempts, lease_seconds, done),
+                         name=f"outbox-lease-{row['id'][:8]}", daemon=True).start()
+        try:
+            handler = self._handlers[row["kind"]]
+            result = handler(payload)
+        except Exception as e:
+            done.set()
+            now = int(time.time())
+            if attempts >= self.max_attempts:
+                status, next_attempt = DEAD, now
+                logger.error(f"Outbox message {row['id']} ({row['kind']}) dead after {attempts} attempts: {e}")
+            else:
+                delay = min(self.backoff_base ** (attempts - 1), self.backoff_max)
+                status, next_attempt = QUEUED, now + int(delay * random.uniform(0.8, 1.2)) + 1
+                logger.warning(f"Outbox message {row['id']} ({row['kind']}) attempt {attempts} failed: {e}")
+            self._finish(
+                row, attempts,
+                "UPDATE outbox SET status=?, payload=?, next_attempt_at=?, last_error=?, updated_at=?",
+                (status, json.dumps(payload), next_attempt, str(e)[:1000], now),
+            )
+            return
+        done.set()
+        self._finish(
+            row, attempts,
+            "UPDATE outbox SET status=?, payload=?, result=?, last_error=NULL, updated_at=?",
+            (SENT, json.dumps(payload), json.dumps(result), int(time.time())),
+        )
+
+    def _run(self, pool=None):
+        while True:
+            try:
+                row = self._claim(pool)
+            except Exception as e:
+                logger.error(f"Outbox claim failed: {e}")
+                row = None
+            if row is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            try:
+                self._deliver(row)
+            except Exception as e:
+                # Lease lapses and the message is retried
+                logger.error(f"Outbox delivery bookkeeping failed for {row['id']}: {e}")
@@ -0,0 +1,218 @@
+"""
+Retention for stored recordings.
+
+A background sweeper keeps the recording store inside a byte quota and an age
+limit. Each pass:
+
+1. deletes recordings older than `max_age_seconds`, oldest first;
+2. optionally re-encodes recordings older than `downscale_after_seconds` to a
+   small low-bitrate copy and drops the original (a cheaper storage tier
+   before deletion);
+3. while the store is over `quota_bytes`, evicts the least recently played
+   (or oldest) recordings.
+
+Work is done in small batches with a pause between them. Rows are claimed in
+a short write transaction, and files are deleted or encoded outside it, so a
+sweep never holds the database or a request thread for long. Catalogue rows
+are kept, with `deleted_at` set, so audits still find the metadata.
+Files are content-addressed and can be shared by several rows, so eviction
+works on a whole content hash at a time, and a hash is never touched while
+any of its rows has a WhatsApp job that hasn't been sent yet.
+"""
+import os
+import time
+import fcntl
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+PENDING_JOB = "SELECT id FROM outbox WHERE status IN ('queued', 'sending')"
+PENDING_SHA256 = f"SELECT sha256 FROM recordings WHERE job_id IN ({PENDING_JOB})"
+
+
+class RetentionSweeper:
+    """Background quota/age enforcement for the recordings table and its files."""
+
+    def __init__(self, db, lock_path, quota_bytes=0, max_age_seconds=0, downscale_after_seconds=0,
+                 transcoder=None, eviction="lru", batch_size=50, interval=300, pause=0.5):
+        self.db = db
+        self.lock_path = lock_path
+        self.quota_bytes = quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.downscale_after_seconds = downscale_after_seconds
+        self.transcoder = transcoder
+        self.order = "last_accessed_at" if eviction == "lru" else "created_at"
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._pid = None
+        # Optional hook: observer(reason, files, bytes_reclaimed) after every batch
+        self.observer = None
+
+    # -----------------------------
+    # Queries
+    # -----------------------------
+    def usage(self):
+        """Bytes held by stored (not deleted) recordings, counting shared files once."""
+        row = self.db.query_one(
+            "SELECT COALESCE(SUM(size), 0) AS n FROM ("
+            "SELECT path, MAX(size) AS size FROM recordings WHERE deleted_at IS NULL GROUP BY path)"
+        )
+        return row["n"]
+
+    def _candidates(self, where, params, order, limit):
+        return self.db.query(
+            f"SELECT DISTINCT sha256 FROM recordings WHERE deleted_at IS NULL AND {where} "
+            f"AND sha256 NOT IN ({PENDING_SHA256}) ORDER BY {order} LIMIT ?",
+            (*params, limit),
+        )
+
+    # -----------------------------
+    # Eviction
+    # -----------------------------
+    def _evict(self, sha256, reason):
+        """Tombstone every row of one content hash, then delete its files.
+
+        Returns bytes freed, or None if a job still needs the file.
+        """
+        with self.db.transaction() as con:
+            # A new upload of the same content may have queued a job since
+            # the candidates were picked
+            if con.execute(f"SELECT 1 FROM recordings WHERE sha256=? AND job_id IN ({PENDING_JOB})",
+                           (sha256,)).fetchone():
+                return None
+            rows = con.execute(
+                "SELECT DISTINCT path, size FROM recordings WHERE sha256=? AND deleted_at IS NULL", (sha256,)
+            ).fetchall()
+            con.execute(
+                "UPDATE recordings SET deleted_at=? WHERE sha256=? AND deleted_at IS NULL",
+                (int(time.time()), sha256),
+            )
+        freed = 0
+        for r in rows:
+            root, _ = os.path.splitext(r["path"])
+            for path in (r["path"], f"{root}.wa.mp4"):
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Retention ({reason}) could not delete {path}: {e}")
+        return freed
+
+    def _evict_batch(self, reason, where, params, order, need=None):
+        """Evict up to one batch of candidates, stopping once `need` bytes are freed."""
+        evicted = freed = 0
+        for r in self._candidates(where, params, order, self.batch_size):
+            reclaimed = self._evict(r["sha256"], reason)
+            if reclaimed is None:
+                continue
+            freed += reclaimed
+            evicted += 1
+            if need is not None and freed >= need:
+                break
+        if evicted:
+            logger.info(f"Retention ({reason}): removed {evicted} recordings, {freed} bytes")
+            if self.observer:
+                self.observer(reason, evicted, freed)
+        return evicted
+
+    def _downscale_batch(self, cutoff):
+        if not (self.transcoder and self.transcoder.available):
+            return 0
+        # Encodes are slow, so only a couple per batch
+        rows = self._candidates("downscaled_at IS NULL AND downscale_failed_at IS NULL AND created_at < ?",
+                                (cutoff,), "created_at", 2)
+        for r in rows:
+            stored = self.db.query_one(
+                "SELECT path, size FROM recordings WHERE sha256=? AND deleted_at IS NULL LIMIT 1", (r["sha256"],)
+            )
+            if stored is None or not os.path.exists(stored["path"]):
+                self._evict(r["sha256"], "missing")  # file already gone; just tombstone it
+                continue
+            root, _ = os.path.splitext(stored["path"])
+            low = f"{root}.low.mp4"
+            try:
+                self.transcoder.downscale(stored["path"], low)
+            except Exception as e:
+                logger.warning(f"Retention (downscale) failed for {r['sha256']}: {e}")
+                # Don't retry a file ffmpeg can't handle on every pass; the
+                # original stays, so downscaled_at (and the playback ETag) don't change
+                self.db.execute(
+                    "UPDATE recordings SET downscale_failed_at=? WHERE sha256=? AND downscaled_at IS NULL",
+                    (int(time.time()), r["sha256"]),
+                )
+                continue
+            size = os.path.getsize(low)
+            with self.db.transaction() as con:
+                # A new upload of the same content may have queued a job on the
+                # original during the encode; it keeps the original
+                busy = con.execute(f"SELECT 1 FROM recordings WHERE sha256=? AND job_id IN ({PENDING_JOB})",
+                                   (r["sha256"],)).fetchone()
+                if not busy:
+                    con.execute(
+                        "UPDATE recordings SET path=?, size=?, downscaled_at=? "
+                        "WHERE sha256=? AND path=? AND deleted_at IS NULL",
+                        (low, size, int(time.time()), r["sha256"], stored["path"]),
+                    )
+            if busy:
+                os.remove(low)
+                continue
+            freed = 0
+            for path in (stored["path"], f"{root}.wa.mp4"):
+                try:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            freed -= size
+            logger.info(f"Retention (downscale): {r['sha256']} now {size} bytes, freed {freed}")
+            if self.observer:
+                self.observer("downscale", 1, freed)
+        return len(rows)
+
+    # -----------------------------
+    # Sweeping
+    # -----------------------------
+    def sweep(self):
+        """One full pass, in batches. Returns False if another process is already sweeping."""
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            now = int(time.time())
+            if self.max_age_seconds:
+                while self._evict_batch("age", "created_at < ?", (now - self.max_age_seconds,), "created_at"):
+                    time.sleep(self.pause)
+            if self.downscale_after_seconds:
+                while self._downscale_batch(now - self.downscale_after_seconds):
+                    time.sleep(self.pause)
+            if self.quota_bytes:
+                need = self.usage() - self.quota_bytes
+                while need > 0:
+                    if not self._evict_batch("quota", "1=1", (), self.order, need):
+                        logger.warning("Retention: over quota but nothing left that can be evicted")
+                        break
+                    time.sleep(self.pause)
+                    need = self.usage() - self.quota_bytes
+        return True
+
+    def start(self):
+        """Run sweeps every `interval` seconds in a daemon thread (restarted after fork)."""
+        if self._pid == os.getpid() or not (self.quota_bytes or self.max_age_seconds or self.downscale_after_seconds):
+            return
+        self._pid = os.getpid()
+
+        def run():
+            while True:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Retention sweep failed: {e}")
+                time.sleep(self.interval)
+
+        threading.Thread(target=run, name="retention", daemon=True).start()
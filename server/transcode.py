@@ -0,0 +1,178 @@
+"""
+Re-encode recordings that WhatsApp would reject.
+
+WhatsApp refuses videos over 16 MB, and the agent records at a fixed CRF, so
+a busy screen can produce a file that is too big. `Transcoder.fit()` probes a
+recording and, when it is over the size limit or the target bitrate,
+re-encodes a copy with ffmpeg at a bitrate computed from its duration: one
+pass first, and a two-pass encode if that still overshoots. The original is
+left untouched next to the copy. Encodes write to a private temp file that
+is renamed into place once complete, so two jobs for the same content never
+see each other's half-written output.
+
+The heavy lifting happens in ffmpeg child processes; a semaphore bounds how
+many run at once per server process so encodes can't starve the machine.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+WHATSAPP_MAX_VIDEO_BYTES = 16 * 1024 * 1024
+
+
+def _temp_beside(path):
+    """A new, uniquely named temp file next to `path` (same filesystem, so it can be renamed over it)."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".",
+                               prefix=f".{os.path.basename(path)}.", suffix=".tmp.mp4")
+    os.close(fd)
+    return tmp
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class TranscodeError(RuntimeError):
+    """ffmpeg/ffprobe failed, or the recording can't be made small enough."""
+
+
+class Transcoder:
+    """Bounded pool of ffmpeg encodes that fit recordings under a size limit."""
+
+    def __init__(self, workers=2, max_bytes=WHATSAPP_MAX_VIDEO_BYTES, target_kbps=0, audio_kbps=64,
+                 preset="veryfast", ffmpeg="ffmpeg", ffprobe="ffprobe", timeout=900):
+        self.max_bytes = max_bytes
+        self.target_kbps = target_kbps
+        self.audio_kbps = audio_kbps
+        self.preset = preset
+        self.ffmpeg = shutil.which(ffmpeg)
+        self.ffprobe = shutil.which(ffprobe)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max(1, workers))
+        # Optional hook: observer(wall_seconds, media_seconds, passes) after every encode
+        self.observer = None
+
+    @property
+    def available(self):
+        return bool(self.ffmpeg and self.ffprobe)
+
+    def _run(self, args):
+        try:
+            proc = subprocess.run(args, capture_output=True, timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            raise TranscodeError(f"{os.path.basename(args[0])} timed out after {self.timeout}s")
+        if proc.returncode != 0:
+            raise TranscodeError(proc.stderr.decode(errors="replace").strip()[-500:] or f"exit {proc.returncode}")
+        return proc.stdout
+
+    def probe(self, path):
+        """(duration seconds, overall bitrate kbps) of a media file."""
+        out = self._run([self.ffprobe, "-v", "error", "-show_entries", "format=duration,bit_rate",
+                         "-of", "json", path])
+        fmt = json.loads(out).get("format", {})
+        duration = float(fmt.get("duration") or 0)
+        if duration <= 0:
+            raise TranscodeError(f"could not read duration of {path}")
+        bit_rate = float(fmt.get("bit_rate") or os.path.getsize(path) * 8 / duration)
+        return duration, bit_rate / 1000
+
+    def needs_transcode(self, path, bitrate_kbps=None):
+        if os.path.getsize(path) > self.max_bytes:
+            return True
+        return bool(self.target_kbps and bitrate_kbps and bitrate_kbps > self.target_kbps * 1.1)
+
+    def video_kbps(self, duration):
+        """Video bitrate that keeps `duration` seconds under max_bytes (with muxing headroom)."""
+        budget = self.max_bytes * 8 / 1000 / duration * 0.92 - self.audio_kbps
+        if self.target_kbps:
+            budget = min(budget, self.target_kbps - self.audio_kbps)
+        if budget < 100:
+            raise TranscodeError(f"{duration:.0f}s of video can't fit in {self.max_bytes} bytes")
+        return int(budget)
+
+    def fit(self, path):
+        """Return a path to send: `path` itself, or a re-encoded copy that fits."""
+        if os.path.getsize(path) <= self.max_bytes and not self.target_kbps:
+            return path
+        if not self.available:
+            logger.warning(f"ffmpeg/ffprobe not found; sending {path} as recorded")
+            return path
+
+        duration, bitrate = self.probe(path)
+        if not self.needs_transcode(path, bitrate):
+            return path
+
+        root, _ = os.path.splitext(path)
+        out = f"{root}.wa.mp4"
+        if os.path.exists(out) and 0 < os.path.getsize(out) <= self.max_bytes:
+            return out  # already encoded for an earlier job (recordings are content-addressed)
+        kbps = self.video_kbps(duration)
+        tmp = _temp_beside(out)  # renamed into place only once it fits
+        try:
+            with self._slots:
+                started = time.perf_counter()
+                self._encode(path, tmp, kbps)
+                passes = 1
+                if os.path.getsize(tmp) > self.max_bytes:
+                    # Single-pass ABR overshoots on bursty screen content; two-pass
+                    # spreads the same budget over the whole recording
+                    kbps = int(kbps * self.max_bytes / os.path.getsize(tmp) * 0.95)
+                    self._encode(path, tmp, kbps, two_pass=True)
+                    passes = 2
+                elapsed = time.perf_counter() - started
+
+            size = os.path.getsize(tmp)
+            if size > self.max_bytes:
+                raise TranscodeError(f"re-encoded {path} is still {size} bytes")
+            os.replace(tmp, out)
+        finally:
+            _discard(tmp)
+        logger.info(f"Transcoded {os.path.basename(path)} to {kbps} kbps in {passes} pass(es): "
+                    f"{os.path.getsize(path)} -> {size} bytes, {duration / elapsed:.1f}x realtime")
+        if self.observer:
+            self.observer(elapsed, duration, passes)
+        return out
+
+    def downscale(self, src, dest, height=480, kbps=300):
+        """Re-encode `src` to a small archival copy at `dest` (for the retention tier)."""
+        tmp = _temp_beside(dest)
+        try:
+            with self._slots:
+                self._run([self.ffmpeg, "-y", "-v", "error", "-i", src, "-vf", f"scale=-2:'min({height},ih)'",
+                           "-c:v", "libx264", "-preset", self.preset, "-b:v", f"{kbps}k", "-pix_fmt", "yuv420p",
+                           "-c:a", "aac", "-b:a", "32k", "-movflags", "+faststart", tmp])
+            os.replace(tmp, dest)
+        finally:
+            _discard(tmp)
+        return dest
+
+    def _encode(self, src, dest, kbps, two_pass=False):
+        video = ["-c:v", "libx264", "-preset", self.preset, "-b:v", f"{kbps}k",
+                 "-maxrate", f"{int(kbps * 1.5)}k", "-bufsize", f"{kbps * 2}k", "-pix_fmt", "yuv420p"]
+        audio = ["-c:a", "aac", "-b:a", f"{self.audio_kbps}k"]
+        if not two_pass:
+            self._run([self.ffmpeg, "-y", "-v", "error", "-i", src, *video, *audio,
+                       "-movflags", "+faststart", dest])
+            return
+        passlog = f"{dest}.passlog"
+        try:
+            self._run([self.ffmpeg, "-y", "-v", "error", "-i", src, *video, "-pass", "1",
+                       "-passlogfile", passlog, "-an", "-f", "mp4", os.devnull])
+            self._run([self.ffmpeg, "-y", "-v", "error", "-i", src, *video, "-pass", "2",
+                       "-passlogfile", passlog, *audio, "-movflags", "+faststart", dest])
+        finally:
+            for suffix in ("-0.log", "-0.log.mbtree"):
+                try:
+                    os.remove(passlog + suffix)
+                except OSError:
+                    pass
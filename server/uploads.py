@@ -0,0 +1,373 @@
+"""
+Resumable, chunked recording uploads.
+
+An agent creates a session declaring the file's size (and optionally its
+SHA-256), then PUTs byte ranges in any order, each with its own checksum. The
+server writes every verified chunk at its offset in a preallocated part file
+and records which ranges it holds, so after a dropped connection the agent
+asks for the session and re-sends only what is missing. Finalizing checks
+that every byte arrived and that the whole-file digest matches, then moves
+the part file into place (a rename, not a copy). A session declaring content
+the server already stores starts out complete, so nothing is re-sent.
+
+Single-request multipart uploads go through `StreamingRequest`, which has
+Werkzeug write the file part straight into the upload directory while hashing
+and size-checking it, instead of spooling it to a temp file first.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import logging
+import tempfile
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+logger = logging.getLogger(__name__)
+
+OPEN = "open"
+COMPLETE = "complete"
+
+CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+|\*)$")
+
+
+class UploadError(Exception):
+    """A request the upload protocol rejects; `status` is the HTTP status to answer with."""
+
+    def __init__(self, error, status=400, details=None):
+        super().__init__(details or error)
+        self.error = error
+        self.status = status
+        self.details = details
+
+
+def parse_content_range(header):
+    """`bytes start-end/total` -> (start, end_exclusive, total or None)."""
+    m = CONTENT_RANGE.match((header or "").strip())
+    if not m:
+        raise UploadError("bad_content_range", 400, "expected 'bytes start-end/total'")
+    start, last = int(m.group(1)), int(m.group(2))
+    if last < start:
+        raise UploadError("bad_content_range", 400, "range end before start")
+    total = None if m.group(3) == "*" else int(m.group(3))
+    return start, last + 1, total
+
+
+def merge_ranges(ranges, start, end):
+    """Add [start, end) to a sorted list of disjoint [start, end) ranges."""
+    merged = []
+    for s, e in sorted(ranges + [[start, end]]):
+        if merged and s <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return merged
+
+
+def missing_ranges(ranges, size):
+    """Gaps in `ranges` over [0, size)."""
+    gaps, pos = [], 0
+    for s, e in ranges:
+        if s > pos:
+            gaps.append([pos, s])
+        pos = max(pos, e)
+    if pos < size:
+        gaps.append([pos, size])
+    return gaps
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadSessions:
+    """Upload sessions in SQLite, chunk data in part files under `root`."""
+
+    def __init__(self, db, root, chunk_size=1024 * 1024, max_size=512 * 1024 * 1024, ttl_seconds=24 * 3600):
+        self.db = db
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_chunk = 4 * chunk_size
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+    def part_path(self, session_id):
+        return os.path.join(self.root, f"{session_id}.part")
+
+    # -----------------------------
+    # Sessions
+    # -----------------------------
+    def create(self, filename, size, sha256=None, meta=None, exists=None):
+        """Open a session. If `exists(sha256)` says the server already holds
+        this content, the session starts out fully received and nothing
+        needs to be sent before finalizing."""
+        if not filename:
+            raise UploadError("filename missing")
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError("bad_size", 400, "size must be a positive integer")
+        if size > self.max_size:
+            raise UploadError("too_large", 413, f"max upload size is {self.max_size} bytes")
+        if sha256 is not None and not isinstance(sha256, str):
+            raise UploadError("bad_sha256", 400, "sha256 must be a hex string")
+        sha256 = (sha256 or "").strip().lower() or None
+
+        self.expire()
+        session_id = str(uuid.uuid4())
+        received = []
+        if sha256 and exists and exists(sha256):
+            received = [[0, size]]
+        else:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.part_path(session_id), "wb") as fh:
+                fh.truncate(size)  # sparse; chunks can land at any offset
+
+        now = int(time.time())
+        self.db.execute(
+            "INSERT INTO upload_sessions (id, filename, size, sha256, meta, received, received_bytes, status, "
+            "created_at, updated_at) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            (session_id, filename, size, sha256, json.dumps(meta or {}), json.dumps(received),
+             size if received else 0, OPEN, now, now),
+        )
+        return self.get(session_id)
+
+    def get(self, session_id):
+        row = self.db.query_one("SELECT * FROM upload_sessions WHERE id=?", (session_id,))
+        return self._view(row) if row else None
+
+    def _view(self, row):
+        received = json.loads(row["received"])
+        return {
+            "id": row["id"],
+            "filename": row["filename"],
+            "size": row["size"],
+            "status": row["status"],
+            "chunk_size": self.chunk_size,
+            "received_bytes": row["received_bytes"],
+            "offset": received[0][1] if received and received[0][0] == 0 else 0,
+            "received": received,
+            "missing": missing_ranges(received, row["size"]),
+            "meta": json.loads(row["meta"]) if row["meta"] else {},
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    # -----------------------------
+    # Chunks
+    # -----------------------------
+    def write_chunk(self, session_id, content_range, checksum, stream):
+        """Verify one ranged chunk read from `stream` and write it at its offset."""
+        start, end, total = parse_content_range(content_range)
+        row = self.db.query_one("SELECT size, status FROM upload_sessions WHERE id=?", (session_id,))
+        if row is None:
+            raise UploadError("not_found", 404)
+        if row["status"] != OPEN:
+            raise UploadError("session_closed", 409)
+        if total is not None and total != row["size"]:
+            raise UploadError("bad_content_range", 400, f"total must equal session size {row['size']}")
+        if end > row["size"]:
+            raise UploadError("bad_content_range", 416, "range beyond end of file")
+        if end - start > self.max_chunk:
+            raise UploadError("chunk_too_large", 413, f"max chunk size is {self.max_chunk} bytes")
+        if not checksum:
+            raise UploadError("checksum missing", 400, "send X-Chunk-SHA256")
+
+        # A chunk is at most max_chunk bytes, so it is verified in memory before
+        # it can overwrite bytes an earlier chunk already delivered
+        length = end - start
+        data = stream.read(length)
+        if len(data) != length or stream.read(1):
+            raise UploadError("length_mismatch", 400, f"body must be exactly {length} bytes")
+        if hashlib.sha256(data).hexdigest() != checksum.strip().lower():
+            raise UploadError("checksum_mismatch", 422)
+
+        with open(self.part_path(session_id), "r+b") as fh:
+            fh.seek(start)
+            fh.write(data)
+
+        with self.db.transaction() as con:
+            current = con.execute(
+                "SELECT received, status FROM upload_sessions WHERE id=?", (session_id,)
+            ).fetchone()
+            if current is None or current["status"] != OPEN:
+                raise UploadError("session_closed", 409)
+            received = merge_ranges(json.loads(current["received"]), start, end)
+            con.execute(
+                "UPDATE upload_sessions SET received=?, received_bytes=?, updated_at=? WHERE id=?",
+                (json.dumps(received), sum(e - s for s, e in received), int(time.time()), session_id),
+            )
+        return length
+
+    # -----------------------------
+    # Finalize & cleanup
+    # -----------------------------
+    def finalize(self, session_id, store, on_complete=None):
+        """Check the assembled file and move it into `store` (a BlobStore).
+
+        `on_complete(con, path, sha256)` runs in the transaction that marks
+        the session complete (e.g. to enqueue the follow-up job); its result
+        must be JSON-serializable and is stored with the session. The part
+        file is moved only after that, as the transaction's last step, so a
+        failed `on_complete` leaves it in place for a retry. Content the store
+        already holds (sessions deduplicated at creation, or a finalize whose
+        commit failed after the move) is found again by its hash. Returns
+        (view, result, repeated): finalizing a complete session again is a
+        no-op that returns the stored result with repeated=True, so agents
+        can safely retry a lost response.
+        """
+        view = self.get(session_id)
+        if view is None:
+            raise UploadError("not_found", 404)
+        if view["status"] == COMPLETE:
+            return view, self._result(session_id), True
+        if view["missing"]:
+            raise UploadError("incomplete", 409, f"missing ranges: {view['missing'][:10]}")
+
+        row = self.db.query_one("SELECT sha256 FROM upload_sessions WHERE id=?", (session_id,))
+        part = self.part_path(session_id)
+        if os.path.exists(part):
+            sha256 = file_sha256(part)
+            if row["sha256"] and sha256 != row["sha256"]:
+                raise UploadError("checksum_mismatch", 422, f"file sha256 is {sha256}")
+            if not row["sha256"]:
+                # Lets a retry find the blob if the part is moved but the commit fails
+                self.db.execute("UPDATE upload_sessions SET sha256=? WHERE id=? AND status=?",
+                                (sha256, session_id, OPEN))
+        elif row["sha256"]:
+            sha256 = row["sha256"]
+        else:
+            raise UploadError("session_closed", 409, "upload data is gone")
+
+        result = None
+        with self.db.transaction() as con:
+            changed = con.execute(
+                "UPDATE upload_sessions SET status=?, updated_at=? WHERE id=? AND status=?",
+                (COMPLETE, int(time.time()), session_id, OPEN),
+            ).rowcount
+            if changed:
+                if not (os.path.exists(part) or store.exists(sha256)):
+                    # Deduplicated at creation, but the stored copy was evicted since
+                    raise UploadError("session_closed", 409, "upload data is gone")
+                path = store.path_for(sha256)
+                result = on_complete(con, path, sha256) if on_complete else path
+                con.execute("UPDATE upload_sessions SET result=? WHERE id=?", (json.dumps(result), session_id))
+                store.put(part, sha256)
+        if not changed:
+            # A concurrent finalize got there first
+            return self.get(session_id), self._result(session_id), True
+        return self.get(session_id), result, False
+
+    def _result(self, session_id):
+        row = self.db.query_one("SELECT result FROM upload_sessions WHERE id=?", (session_id,))
+        return json.loads(row["result"]) if row and row["result"] else None
+
+    def expire(self, limit=100):
+        """Drop sessions idle for longer than the TTL, with their part files."""
+        cutoff = int(time.time()) - self.ttl_seconds
+        rows = self.db.query(
+            "SELECT id FROM upload_sessions WHERE updated_at < ? LIMIT ?", (cutoff, limit)
+        )
+        for r in rows:
+            try:
+                os.remove(self.part_path(r["id"]))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not remove upload part {r['id']}: {e}")
+                continue
+            self.db.execute("DELETE FROM upload_sessions WHERE id=? AND updated_at < ?", (r["id"], cutoff))
+        return len(rows)
+
+
+# -----------------------------
+# Streaming multipart receive
+# -----------------------------
+class IncomingFile:
+    """Write-through file for one multipart file part.
+
+    Bytes go straight to a part file in `directory` as Werkzeug parses them,
+    updating a SHA-256 and a byte count on the way; exceeding `max_size`
+    aborts the request with 413 at that point. `keep()` renames the part file
+    into place; otherwise `close()` deletes it.
+    """
+
+    def __init__(self, directory, max_size=None):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix="incoming-", suffix=".part", dir=directory)
+        self._fh = os.fdopen(fd, "w+b")
+        self._digest = hashlib.sha256()
+        self.max_size = max_size
+        self.size = 0
+        self.kept = False
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    @property
+    def closed(self):
+        return self._fh.closed
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            raise RequestEntityTooLarge(f"max upload size is {self.max_size} bytes")
+        self._digest.update(data)
+        return self._fh.write(data)
+
+    def seek(self, *args):
+        return self._fh.seek(*args)
+
+    def tell(self):
+        return self._fh.tell()
+
+    def read(self, *args):
+        return self._fh.read(*args)
+
+    def readline(self, *args):
+        return self._fh.readline(*args)
+
+    def flush(self):
+        self._fh.flush()
+
+    def keep(self, dest_path):
+        """Move the received file to `dest_path` (same filesystem, so a rename)."""
+        self._fh.close()
+        os.replace(self.path, dest_path)
+        self.kept = True
+
+    def close(self):
+        self._fh.close()
+        if not self.kept:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class StreamingRequest(Request):
+    """Flask request whose multipart file parts are `IncomingFile`s.
+
+    Set `incoming_dir` (on the filesystem of the final upload directory) and
+    `max_file_size` before serving.
+    """
+
+    incoming_dir = "uploads/.incoming"
+    max_file_size = None
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        incoming = IncomingFile(self.incoming_dir, self.max_file_size)
+        # Tracked here too: a part abandoned mid-parse never reaches request.files
+        self.__dict__.setdefault("_incoming", []).append(incoming)
+        return incoming
+
+    def close(self):
+        super().close()
+        for incoming in self.__dict__.get("_incoming", ()):
+            incoming.close()
@@ -0,0 +1,268 @@
+"""
+WhatsApp Cloud API client.
+
+One `WhatsAppClient` per process holds a keep-alive connection pool to the
+Graph API, throttles itself with token buckets that mirror Meta's limits
+(messages per second per business number, and the per-recipient "pair" rate),
+retries throttled calls after Retry-After, and keeps per-endpoint latency
+stats. Point `api_base` at a local stand-in to run everything offline.
+"""
+import os
+import re
+import time
+import logging
+import mimetypes
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Graph API error codes that mean "slow down" even when the HTTP status isn't 429
+THROTTLE_ERROR_CODES = {4, 80007, 130429, 131048, 131056}
+
+# Interactive list messages hold at most this many rows across all sections
+LIST_MAX_ROWS = 10
+
+
+def wa_number(value):
+    """A phone number as WhatsApp reports senders: digits only ("+91 98765-43210" -> "919876543210")."""
+    return re.sub(r"\D", "", str(value or ""))
+
+
+class RateLimited(RuntimeError):
+    """Raised when a send would have to wait longer than the client allows."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `capacity`."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout):
+        """Take one token, waiting up to `timeout` seconds; returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Drain the bucket so nothing is sent for `seconds` (after a 429)."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+            self._updated = time.monotonic()
+
+
+class WhatsAppClient:
+    """Pooled, rate-limited WhatsApp Cloud API client."""
+
+    def __init__(self, token, phone_id, owner=None, api_base="https://graph.facebook.com",
+                 api_version="v21.0", rate_per_second=80, pair_rate_per_second=1 / 6, pair_burst=45,
+                 pool_size=20, max_retries=3, max_wait=30):
+        self.token = token
+        self.phone_id = phone_id
+        self.owner = owner
+        self.api_base = api_base.rstrip("/")
+        self.api_version = api_version
+        self.max_retries = max_retries
+        self.max_wait = max_wait
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Authorization"] = f"Bearer {token}"
+
+        self._bucket = TokenBucket(rate_per_second, rate_per_second)
+        self._pair_rate = pair_rate_per_second
+        self._pair_burst = pair_burst
+        self._pair_buckets = {}
+        self._lock = threading.Lock()
+        self._stats = {}
+        # Optional hook: observer(endpoint, seconds, error, throttled) after every call
+        self.observer = None
+
+    @property
+    def messages_url(self):
+        return f"{self.api_base}/{self.api_version}/{self.phone_id}/messages"
+
+    @property
+    def media_url(self):
+        return f"{self.api_base}/{self.api_version}/{self.phone_id}/media"
+
+    def _require(self, to=None, need_recipient=True):
+        if not (self.token and self.phone_id):
+            raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID)")
+        if need_recipient and not to:
+            raise RuntimeError("WhatsApp env vars missing (TOKEN/PHONE_ID/OWNER_WA_NUMBER)")
+
+    def _pair_bucket(self, to):
+        with self._lock:
+            bucket = self._pair_buckets.get(to)
+            if bucket is None:
+                bucket = self._pair_buckets[to] = TokenBucket(self._pair_rate, self._pair_burst)
+            return bucket
+
+    # -----------------------------
+    # Stats
+    # -----------------------------
+    def _record(self, endpoint, seconds, error=False, throttled=False):
+        with self._lock:
+            s = self._stats.setdefault(endpoint, {
+                "calls": 0, "errors": 0, "throttled": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+            })
+            s["calls"] += 1
+            s["errors"] += int(error)
+            s["throttled"] += int(throttled)
+            s["total_seconds"] += seconds
+            s["max_seconds"] = max(s["max_seconds"], seconds)
+        if self.observer:
+            self.observer(endpoint, seconds, error, throttled)
+
+    def stats(self):
+        """Per-endpoint call counts and latency (seconds)."""
+        with self._lock:
+            out = {}
+            for endpoint, s in self._stats.items():
+                out[endpoint] = dict(s, avg_seconds=s["total_seconds"] / s["calls"] if s["calls"] else 0.0)
+            return out
+
+    # -----------------------------
+    # Transport
+    # -----------------------------
+    @staticmethod
+    def _is_throttled(response):
+        if response.status_code == 429:
+            return True
+        if response.status_code in (400, 403):
+            try:
+                return response.json().get("error", {}).get("code") in THROTTLE_ERROR_CODES
+            except ValueError:
+                return False
+        return False
+
+    def _post(self, endpoint, url, timeout, to=None, **kwargs):
+        """POST with rate limiting and Retry-After handling; returns the response JSON."""
+        buckets = [self._bucket] + ([self._pair_bucket(to)] if to else [])
+        for attempt in range(self.max_retries + 1):
+            for bucket in buckets:
+                if not bucket.acquire(self.max_wait):
+                    raise RateLimited(f"WhatsApp {endpoint} rate limit: no send slot within {self.max_wait}s")
+
+            if "files" in kwargs:
+                # Rewind file bodies so a retried upload sends the whole file again
+                for part in kwargs["files"].values():
+                    if hasattr(part[1], "seek"):
+                        part[1].seek(0)
+
+            started = time.perf_counter()
+            try:
+                r = self.session.post(url, timeout=timeout, **kwargs)
+            except requests.RequestException:
+                self._record(endpoint, time.perf_counter() - started, error=True)
+                raise
+            elapsed = time.perf_counter() - started
+
+            if self._is_throttled(r) and attempt < self.max_retries:
+                try:
+                    retry_after = float(r.headers.get("Retry-After", ""))
+                except ValueError:
+                    retry_after = 2 ** attempt
+                self._record(endpoint, elapsed, throttled=True)
+                logger.warning(f"WhatsApp {endpoint} throttled (HTTP {r.status_code}); retrying in {retry_after}s")
+                for bucket in buckets:
+                    bucket.pause(retry_after)
+                continue
+
+            self._record(endpoint, elapsed, error=not r.ok, throttled=self._is_throttled(r))
+            r.raise_for_status()
+            return r.json()
+
+    # -----------------------------
+    # Messages & media
+    # -----------------------------
+    def send_text(self, text: str, to: str = None):
+        to = to or self.owner
+        self._require(to)
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": text},
+        }
+        return self._post("send_text", self.messages_url, 20, to=to, json=payload)
+
+    def send_buttons(self, text: str, action_id: str, to: str = None):
+        to = to or self.owner
+        self._require(to)
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "interactive",
+            "interactive": {
+                "type": "button",
+                "body": {"text": text},
+                "action": {
+                    "buttons": [
+                        {"type": "reply", "reply": {"id": f"yes_{action_id}", "title": "YES"}},
+                        {"type": "reply", "reply": {"id": f"no_{action_id}", "title": "NO"}},
+                    ]
+                },
+            },
+        }
+        return self._post("send_buttons", self.messages_url, 20, to=to, json=payload)
+
+    def send_list(self, text: str, button: str, sections: list, to: str = None):
+        """Interactive list message; `sections` is [{"title", "rows": [{"id", "title", "description"?}]}].
+
+        WhatsApp allows at most LIST_MAX_ROWS rows across all sections.
+        """
+        to = to or self.owner
+        self._require(to)
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "interactive",
+            "interactive": {
+                "type": "list",
+                "body": {"text": text[:1024]},
+                "action": {"button": button[:20], "sections": sections},
+            },
+        }
+        return self._post("send_list", self.messages_url, 20, to=to, json=payload)
+
+    def upload_media(self, file_path: str, mime: str = None):
+        self._require(need_recipient=False)
+        mime = mime or mimetypes.guess_type(file_path)[0] or "video/mp4"
+        with open(file_path, "rb") as fh:
+            files = {
+                "file": (os.path.basename(file_path), fh, mime),
+                "messaging_product": (None, "whatsapp"),
+            }
+            return self._post("upload_media", self.media_url, 90, files=files)["id"]
+
+    def send_media(self, media_id: str, caption: str, to: str = None):
+        to = to or self.owner
+        self._require(to)
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "video",
+            "video": {"id": media_id, "caption": caption[:1024]},
+        }
+        return self._post("send_media", self.messages_url, 30, to=to, json=payload)